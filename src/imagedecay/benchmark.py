@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Compare encode time and file size of output formats and encoder settings."""
+
+import json
+import logging
+import os
+import time
+
+from imagedecay.readwrite import read, write
+from imagedecay.thread import main_setup
+
+CMD_ARGS = [  # list of pairs of (args_tuple, kwargs_dict)
+    (['source_image'], {
+        'help': 'path source image',
+        'type': str
+    }),
+    (['temp_image_dir'], {
+        'help': 'path for encoded test images',
+        'type': str
+    }),
+    (['--repeat'], {
+        'help': 'number of repetitions per setting',
+        'default': 3,
+        'type': int
+    })
+]
+
+SETTINGS = [  # list of pairs of (format, encoder_kwargs)
+    ('bmp', {}),
+    ('npy', {}),
+    ('png', {'compress_level': 0}),
+    ('png', {'compress_level': 1}),
+    ('png', {'compress_level': 6}),
+    ('png', {'compress_level': 9}),
+    ('jpg', {'quality': 75}),
+    ('jpg', {'quality': 90}),
+    ('jpg', {'quality': 95}),
+    ('webp', {'quality': 90, 'method': 0}),
+    ('webp', {'quality': 90, 'method': 4}),
+    ('webp', {'lossless': True, 'method': 0}),
+]
+
+
+def benchmark(im_array, path, settings=None, n_repeat=3):
+    """Write image with different settings and measure encode time and file size.
+
+    Args:
+        im_array (array): image data as float
+        path (str): directory for test files
+        settings (list, optional): list of pairs of (format, encoder_kwargs)
+        n_repeat (int, optional): number of repetitions, the fastest is used
+
+    Returns:
+        list of tuples (format, encoder_kwargs, seconds, bytes)
+    """
+    results = list()
+    for i, (fmt, kwargs) in enumerate(settings or SETTINGS):
+        filepath = os.path.join(path, 'benchmark.%06d.%s' % (i, fmt))
+        seconds = None
+        for dummy_i in range(n_repeat):
+            time_start = time.perf_counter()
+            write(im_array, filepath, **kwargs)
+            time_used = time.perf_counter() - time_start
+            seconds = time_used if seconds is None else min(seconds, time_used)
+        results.append((fmt, kwargs, seconds, os.path.getsize(filepath)))
+        os.remove(filepath)
+    return results
+
+
+def format_table(results):
+    """Format benchmark results as markdown table."""
+    lines = ['| format | settings | encode ms | size KB |',
+             '|--------|----------|----------:|--------:|']
+    for fmt, kwargs, seconds, n_bytes in results:
+        lines.append('| %s | `%s` | %0.1f | %0.0f |' % (fmt, json.dumps(kwargs), seconds * 1000,
+                                                       n_bytes / 1024))
+    return '\n'.join(lines)
+
+
+def main(source_image, temp_image_dir, **kwargs):
+    """Entry point for main script."""
+    im_array, im_meta = read(source_image)
+    logging.info('BENCHMARK %s', im_meta)
+    results = benchmark(im_array, temp_image_dir, n_repeat=kwargs.get('repeat', 3))
+    print('%d x %d' % (im_array.shape[1], im_array.shape[0]))
+    print(format_table(results))
+
+
+if __name__ == '__main__':
+    main_setup(main, cmd_args=CMD_ARGS, default_loglevel='WARNING')
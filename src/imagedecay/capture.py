@@ -0,0 +1,140 @@
+# coding=utf-8
+"""Take webcam pictures from a continuously running camera."""
+
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pygame as pyg
+from pygame import camera
+from imagedecay.readwrite import write, convert_to_float
+from imagedecay.thread import MyThread, MyQueue
+
+
+class Capture(MyThread):
+    """Keep the camera open and hold the latest frame, so a picture is taken without delay.
+
+    On ``trigger``, the latest frame is sent to the converter in memory as
+    ``(filepath, im_array)``. If ``path`` is set, the picture is also saved there
+    (in this thread, between two frames). The path should not be scanned by the
+    scanner, or the picture would be converted twice.
+    """
+    def __init__(self, queue_out, path=None, source=None, fmt='png'):
+        super().__init__()
+        self.queue_out = queue_out
+        self.path = path
+        self.source = source or PygameCameraSource()
+        self.fmt = fmt
+        self.frame = None  # latest frame (uint8), replaced, never changed in place
+        self.lock = threading.Lock()
+        self.queue_save = MyQueue()
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def run(self):
+        """Main thread."""
+        logging.info("CAPT START")
+        try:
+            self.source.start()
+        except Exception as err:
+            logging.error('CAPT CAMERA FAILED: %s', err)
+            self.running = False
+            return
+        while self.running:
+            frame = self.source.get_frame()  # waits for the next frame
+            with self.lock:
+                self.frame = frame
+            self.save_pending()
+        self.source.stop()
+        self.save_pending()
+        logging.info("CAPT STOP")
+
+    def trigger(self):
+        """Send the latest frame to the converter.
+
+        Returns:
+            path of the picture, or None if there is no frame yet
+        """
+        with self.lock:
+            frame = self.frame
+        if frame is None:
+            logging.warning('CAPT NO FRAME')
+            return None
+        filename = '_campic.%d.%s' % (int(time.time() * 1000), self.fmt)
+        filepath = os.path.join(self.path, filename) if self.path else filename
+        logging.info('CAPT PICTURE %s', filepath)
+        self.queue_out.put((filepath, frame))
+        if self.path:
+            self.queue_save.put((filepath, frame))
+        return filepath
+
+    def save_pending(self):
+        """Save all pictures taken since the last frame."""
+        item = self.queue_save.get_first_nowait()
+        while item:
+            filepath, frame = item
+            write(convert_to_float(frame), filepath)
+            item = self.queue_save.get_first_nowait()
+
+
+class PygameCameraSource():
+    """Frames from a camera (pygame.camera), as uint8 arrays (height, width, 3).
+
+    Args:
+        device (str, optional): camera device, defaults to the first one
+        size (tuple, optional): requested (width, height)
+    """
+    def __init__(self, device=None, size=(640, 480)):
+        self.device = device
+        self.size = size
+        self.cam = None
+
+    def start(self):
+        """Open the camera."""
+        camera.init()
+        device = self.device or camera.list_cameras()[0]
+        self.cam = camera.Camera(device, self.size)
+        self.cam.start()
+
+    def get_frame(self):
+        """Wait for the next frame."""
+        return pyg.surfarray.array3d(self.cam.get_image()).swapaxes(0, 1)
+
+    def stop(self):
+        """Close the camera."""
+        self.cam.stop()
+        camera.quit()
+
+
+class FakeCameraSource():
+    """Moving test pattern instead of a camera, for testing.
+
+    >>> source = FakeCameraSource(size=(4, 2), fps=1000)
+    >>> source.start()
+    >>> source.get_frame().shape
+    (2, 4, 3)
+    """
+    def __init__(self, size=(640, 480), fps=30.0):
+        self.size = size
+        self.interval_s = 1.0 / fps
+        self.n_frames = 0
+
+    def start(self):
+        """Start the fake camera."""
+        self.n_frames = 0
+
+    def get_frame(self):
+        """Wait for the next frame."""
+        time.sleep(self.interval_s)
+        self.n_frames += 1
+        x_px, y_px = np.meshgrid(np.arange(self.size[0]), np.arange(self.size[1]))
+        frame = np.empty((self.size[1], self.size[0], 3), dtype=np.uint8)
+        frame[..., 0] = (x_px + self.n_frames) % 256
+        frame[..., 1] = (y_px + 2 * self.n_frames) % 256
+        frame[..., 2] = 128
+        return frame
+
+    def stop(self):
+        """Stop the fake camera."""
@@ -2,18 +2,26 @@
 # coding=utf-8
 """Image conversion functions and script."""
 
+import glob
+import hashlib
+import json
 import logging
 import os
+import random
+import time
 
+import numpy as np
 from skimage.transform import rescale
-from imagedecay.readwrite import read, write
-from imagedecay.filter import apply_filterconf, get_conf
+from imagedecay.readwrite import (read, write, write_atomic, normalize, FrameStore,
+                                  FRAMESTORE_FORMAT, get_frame_ref)
+from imagedecay.filter import apply_filterconf, get_conf, set_workers
 from imagedecay.thread import MyThread, main_setup
 
 CMD_ARGS = [  # list of pairs of (args_tuple, kwargs_dict)
     (['source_image'], {
         'help': 'path source images',
-        'type': str
+        'type': str,
+        'nargs': '+'
     }),
     (['temp_image_dir'], {
         'help': 'path for converted images. must be different from image_dir!',
@@ -41,16 +49,38 @@ CMD_ARGS = [  # list of pairs of (args_tuple, kwargs_dict)
         'type': float
     }),
     (['--output_fmt'], {
-        'help': 'output file format',
+        'help': 'output file format (bmp, png, jpg, webp, npy, frames)',
         'default': 'bmp'
+    }),
+    (['--output_opts'], {
+        'help': 'encoder settings as json, e.g. \'{"compress_level": 1}\'',
+        'type': json.loads
+    }),
+    (['--workers', '-w'], {
+        'help': 'number of threads per image',
+        'default': 1,
+        'type': int
+    }),
+    (['--batch_size', '-b'], {
+        'help': 'maximum number of same sized images processed together (1: one by one)',
+        'default': 1,
+        'type': int
     })
 ]
 
+CHECKPOINT_EXT = '.checkpoint'
+CHECKPOINT_DTYPE = np.float32  # image data of checkpoints, unquantized
+ADAPT_WARMUP_STEPS = 1  # not measured: noise banks are built on first use of an image shape
+ADAPT_PROBE_STEPS = 2  # iterations measured before adapting settings
+ADAPT_NOISE_BANK_SIZE = 8
+ADAPT_MIN_SCALE = 0.25
+
 
 class Converter(MyThread):
     """Scan a directory periodically for new files matching a pattern and call a given function."""
     def __init__(self, queue_in, queue_out, path, conf, n_iter, save_steps, max_image_size=None,
-                 output_fmt='bmp', publish_steps=True, list_index='index.html'):
+                 output_fmt='bmp', output_opts=None, publish_steps=True, queue_gallery=None,
+                 queue_retention=None, resume=True, n_workers=1, frame_budget_s=None):
         super().__init__()
         self.queue_in = queue_in
         self.queue_out = queue_out
@@ -60,9 +90,20 @@ class Converter(MyThread):
         self.save_steps = save_steps
         self.max_image_size = max_image_size
         self.output_fmt = output_fmt
+        self.output_opts = output_opts or dict()
         self.publish_steps = publish_steps
         self.imagelist = list()
-        self.list_index = list_index
+        self.framestores = dict()  # open frame stores by path
+        self.queue_gallery = queue_gallery
+        self.queue_retention = queue_retention
+        self.resume = resume
+        self.n_workers = n_workers
+        self.conf_hash = get_conf_hash(conf)
+        self.frame_budget_s = frame_budget_s
+        self.conf_run = conf  # settings used for the current sequence (adaptive mode)
+        self.save_steps_run = save_steps
+        self.save_steps_next = save_steps
+        self.work_scale = 1.0
 
     def resize(self, img):
         """Resize the given image.
@@ -73,121 +114,421 @@ class Converter(MyThread):
         Returns:
             image array
         """
-        scale_x = self.max_image_size[0] / img.shape[1]
-        scale_y = self.max_image_size[1] / img.shape[0]
-        scale = min(scale_x, scale_y)
-        img2 = rescale(img, scale, mode='constant')
+        scale = self.work_scale
+        if self.max_image_size:
+            scale_x = self.max_image_size[0] / img.shape[1]
+            scale_y = self.max_image_size[1] / img.shape[0]
+            scale *= min(scale_x, scale_y)
+        img2 = rescale(img, scale, mode='constant', channel_axis=2)
         logging.info('CONV RESCALE (%d x %d) - %0.2f -> (%d x %d)', img.shape[0], img.shape[1],
                      scale, img2.shape[0], img2.shape[1])
         return img2
 
     def run(self):
-        """Main thread."""
+        """Main thread.
+
+        Input items are paths of source images, or pairs of (path, image array)
+        for images that are already in memory (the path is used for naming only).
+        """
         logging.info("CONV START")
-        template = '<hml>\n<head>\n<link href="style.css" rel="stylesheet">\n</head>\n<body>\n'
-        self.write_to_list_index(template, append=False)
+        set_workers(self.n_workers)
+        checkpoint = self.find_checkpoint()
         filepath_next = None
         while self.running:
             # wait on queue for next input
-            if filepath_next:  # from peek
+            if checkpoint:
+                filepath = checkpoint['source']
+            elif filepath_next:  # from peek
                 filepath = filepath_next
                 filepath_next = None
             else:
                 filepath = self.queue_in.get_last_wait()
-            logging.info("CONV NEW %s", filepath)
+            if not filepath:
+                continue
+            filepath, im_array_in = get_source(filepath)
             self.queue_out.put([])  # set empty cycle
-            self.imagelist = list()
-            im_array = self.read_and_resize(filepath)
-            # save original
-            filepath_out = self.get_output_filename(filepath, 0)
-            write(im_array, filepath_out)
-            self.imagelist.append(filepath_out)
-            if self.publish_steps:
-                logging.info("CONV SHOW %s", filepath_out)
-                self.queue_out.put(filepath_out)  # queue next available
+            self.framestores = dict()
+            time_save = 0.0
+            if checkpoint:
+                logging.info("CONV RESUME %s at step %d", filepath, checkpoint['step'])
+                im_array = self.restore_checkpoint(checkpoint)
+                i_start = checkpoint['step'] + 1
+                checkpoint = None
+                if self.publish_steps:
+                    for filepath_out in self.imagelist:
+                        self.queue_out.put(filepath_out)
+            else:
+                logging.info("CONV NEW %s", filepath)
+                self.imagelist = list()
+                self.save_steps_run = self.save_steps_next
+                self.notify('start', filepath)
+                im_array = self.read_and_resize(filepath, im_array_in)
+                # save original
+                time_start = time.perf_counter()
+                filepath_out = self.save(im_array, filepath, 0)
+                self.imagelist.append(filepath_out)
+                self.write_checkpoint(im_array, filepath, 0)
+                time_save = time.perf_counter() - time_start
+                if self.publish_steps:
+                    logging.info("CONV SHOW %s", filepath_out)
+                    self.queue_out.put(filepath_out)  # queue next available
+                i_start = 1
+            filepath_out = self.imagelist[-1]
             canceled = False
-            for i in range(1, self.n_iter + 1):
+            time_iter = 0.0
+            for i in range(i_start, self.n_iter + 1):
                 # check if there is a new item
                 filepath_next = self.queue_in.get_first_nowait()
                 if filepath_next:
-                    logging.info('CONV CANCEL because of: %s', filepath_next)
+                    logging.info('CONV CANCEL because of: %s', get_source(filepath_next)[0])
+                    self.notify('cancel', filepath)
+                    self.remove_checkpoint(filepath)
                     canceled = True
                     break
                 logging.debug('CONV STEP %5d', i)
                 # apply filter
-                im_array = apply_filterconf(im_array, self.conf)
+                time_start = time.perf_counter()
+                im_array = apply_filterconf(im_array, self.conf_run)
+                n_timed = i - i_start + 1 - ADAPT_WARMUP_STEPS  # first iterations not timed
+                if n_timed > 0:
+                    time_iter += time.perf_counter() - time_start
                 # save
-                if i == self.n_iter or (self.save_steps and i % self.save_steps == 0):
-                    filepath_out = self.get_output_filename(filepath, i)
-                    logging.debug("CONV SAVE %s", filepath_out)
-                    write(im_array, filepath_out)
+                if i == self.n_iter or (self.save_steps_run and i % self.save_steps_run == 0):
+                    time_start = time.perf_counter()
+                    filepath_out = self.save(im_array, filepath, i)
                     # publish right away
                     self.imagelist.append(filepath_out)
+                    self.write_checkpoint(im_array, filepath, i)
+                    time_save = time.perf_counter() - time_start
                     if self.publish_steps:
                         logging.info("CONV SHOW %s", filepath_out)
                         self.queue_out.put(filepath_out)  # queue next available
+                if self.frame_budget_s and n_timed == ADAPT_PROBE_STEPS:
+                    self.adapt(time_iter / ADAPT_PROBE_STEPS, time_save)
             # publish list if sequence finished
             if not canceled:
+                self.notify('done', filepath)
+                self.remove_checkpoint(filepath)
                 self.link_last_img(filepath_out)
                 logging.info("CONV SHOW ALL")
                 self.queue_out.put(self.imagelist)  # set full cycle
             filepath = None  # finished
-        self.write_to_list_index('\n</body>\n</hml>')
         logging.info("CONV STOP")
 
-    def read_and_resize(self, filepath):
-        """Read and resize imge."""
+    def read_and_resize(self, filepath, im_array=None):
+        """Read (unless image data is given) and resize imge."""
         # load image
-        im_array, dummy_meta = read(filepath)
+        if im_array is None:
+            im_array, dummy_meta = read(filepath)
+        else:
+            im_array = normalize(im_array)
         # resize image
-        if self.max_image_size:
+        if self.max_image_size or self.work_scale != 1.0:
             im_array = self.resize(im_array)
         return im_array
 
+    def adapt(self, time_iter, time_save):
+        """Adjust settings so that computing and saving a frame fits into the frame budget.
+
+        The first measure is to use precomputed noise (right away). Then the number of
+        iterations per saved frame is reduced and, if that is not enough, the working
+        resolution. These apply from the next sequence on. If there is enough headroom,
+        the resolution goes back up.
+
+        Args:
+            time_iter (float): measured time per iteration in s
+            time_save (float): measured time per save in s
+        """
+        budget = self.frame_budget_s
+        time_frame = self.save_steps_run * time_iter + time_save
+        if time_frame > budget and self.conf_run is self.conf:
+            self.conf_run = get_fast_noise_conf(self.conf)
+            if self.conf_run != self.conf:
+                logging.info('CONV ADAPT %0.3f s per frame > %0.3f s: noise bank size %d',
+                             time_frame, budget, ADAPT_NOISE_BANK_SIZE)
+                return  # measure again with the new noise
+        save_steps = int((budget - time_save) / max(time_iter, 1e-6))
+        self.save_steps_next = max(1, min(self.save_steps, save_steps))
+        factor = budget / (self.save_steps_next * time_iter + time_save)
+        if factor < 1.0 or (factor > 1.2 and self.work_scale < 1.0):  # cost ~ number of pixels
+            self.work_scale = min(1.0, max(ADAPT_MIN_SCALE,
+                                           self.work_scale * np.sqrt(0.9 * factor)))
+        logging.info('CONV ADAPT %0.3f s per iteration, %0.3f s per save (budget %0.3f s): '
+                     'save_steps %d, scale %0.2f, noise bank %s', time_iter, time_save, budget,
+                     self.save_steps_next, self.work_scale, self.conf_run is not self.conf)
+
     def run_on_image(self, filepath):
         """Run one full cycle on image"""
+        set_workers(self.n_workers)
         im_array = self.read_and_resize(filepath)
         # save original
-        filepath_out = self.get_output_filename(filepath, 0)
-        write(im_array, filepath_out)
+        self.save(im_array, filepath, 0)
         for i in range(1, self.n_iter + 1):
             # apply filter
             im_array = apply_filterconf(im_array, self.conf)
             # save
             if i == self.n_iter or (self.save_steps and i % self.save_steps == 0):
-                filepath_out = self.get_output_filename(filepath, i)
-                write(im_array, filepath_out)
+                self.save(im_array, filepath, i)
+        self.framestores = dict()
 
 
+    def run_on_images(self, filepaths, batch_size=1):
+        """Run full cycles on several images.
+
+        With ``batch_size`` > 1, images of the same size are stacked and processed
+        together in batches. This has not been measured to be faster yet (larger
+        stacks no longer fit into the cache), so images are processed one by one by default.
+
+        Args:
+            filepaths (list): paths of source images
+            batch_size (int, optional): maximum number of images per batch
+        """
+        if batch_size <= 1:
+            for filepath in filepaths:
+                self.run_on_image(filepath)
+            return
+        set_workers(self.n_workers)
+        batches = dict()  # unfinished batches by image shape
+        for filepath in filepaths:
+            im_array = self.read_and_resize(filepath)
+            batch = batches.setdefault(im_array.shape, list())
+            batch.append((filepath, im_array))
+            if len(batch) >= batch_size:
+                self.run_on_batch(batches.pop(im_array.shape))
+        for batch in batches.values():
+            self.run_on_batch(batch)
+
+    def run_on_batch(self, batch):
+        """Run one full cycle on a stack of same sized images.
+
+        Args:
+            batch (list): list of pairs (filepath, image array)
+        """
+        filepaths = [filepath for filepath, dummy_im_array in batch]
+        im_array = np.stack([im_array for dummy_filepath, im_array in batch])
+        logging.info('CONV BATCH %d x (%d x %d)', *im_array.shape[:3])
+        for filepath, im_array_i in zip(filepaths, im_array):
+            self.save(im_array_i, filepath, 0)
+        for i in range(1, self.n_iter + 1):
+            # apply filter
+            im_array = apply_filterconf(im_array, self.conf)
+            # save
+            if i == self.n_iter or (self.save_steps and i % self.save_steps == 0):
+                for filepath, im_array_i in zip(filepaths, im_array):
+                    self.save(im_array_i, filepath, i)
+        self.framestores = dict()
+
+    def save(self, im_array, filepath, i):
+        """Save step of the sequence.
+
+        With output format ``frames``, all steps of a sequence are appended to one
+        memory-mapped frame store, which is created on step 0.
+
+        Args:
+            im_array (array): image data
+            filepath (str): path of the source image
+            i (int): step
+
+        Returns:
+            path (or frame reference) of the saved image
+        """
+        if self.output_fmt == FRAMESTORE_FORMAT:
+            storepath = self.get_output_filename(filepath)
+            if i == 0 or storepath not in self.framestores:
+                capacity = self.n_iter // self.save_steps_run + 2 if self.save_steps_run else 2
+                self.framestores[storepath] = FrameStore.create(storepath, im_array.shape,
+                                                                capacity)
+            filepath_out = get_frame_ref(storepath, self.framestores[storepath].append(im_array))
+        else:
+            storepath = filepath_out = self.get_output_filename(filepath, i)
+            write(im_array, filepath_out, **self.output_opts)
+        logging.debug("CONV SAVE %s", filepath_out)
+        self.notify('frame', filepath, storepath)
+        return filepath_out
+
+    def get_checkpoint_filename(self, filepath):
+        """Get path of checkpoint file (without extension) for source image."""
+        return os.path.join(self.path, os.path.basename(filepath) + CHECKPOINT_EXT)
+
+    def write_checkpoint(self, im_array, filepath, i):
+        """Save state after step i, so the sequence can be resumed after a restart.
+
+        The image data is saved unquantized as ``CHECKPOINT_DTYPE`` in a npy file per
+        step, the state of the random number generators, the published frames and the
+        name of the npy file as json. The json file is replaced last, so it always
+        points to complete image data of the same step. Then the previous npy file
+        is removed.
+        """
+        if not self.resume:
+            return
+        checkpoint_path = self.get_checkpoint_filename(filepath)
+        data_path = '%s-%d.npy' % (checkpoint_path, i)
+        with open(data_path + '.tmp', 'wb') as file:
+            np.save(file, im_array.astype(CHECKPOINT_DTYPE))
+        os.replace(data_path + '.tmp', data_path)
+        np_state = np.random.get_state()
+        py_state = random.getstate()
+        checkpoint = {
+            'source': filepath,
+            'conf_hash': self.conf_hash,
+            'n_iter': self.n_iter,
+            'save_steps': self.save_steps,
+            'save_steps_run': self.save_steps_run,
+            'output_fmt': self.output_fmt,
+            'step': i,
+            'data': os.path.basename(data_path),
+            'imagelist': self.imagelist,
+            'np_random_state': [np_state[0], np_state[1].tolist()] + list(np_state[2:]),
+            'random_state': [py_state[0], list(py_state[1]), py_state[2]]
+        }
+        write_atomic(json.dumps(checkpoint), checkpoint_path + '.json')
+        self.remove_checkpoint(filepath, keep=data_path)
+
+    def find_checkpoint(self):
+        """Find the most recent checkpoint that can be resumed with the current settings.
+
+        All other checkpoints (all, if resuming is disabled) are discarded.
+
+        Returns:
+            checkpoint dict or None
+        """
+        checkpoints = list()
+        for checkpoint_path in glob.glob(os.path.join(glob.escape(self.path),
+                                                      '*%s.json' % CHECKPOINT_EXT)):
+            source = checkpoint_path[:-len(CHECKPOINT_EXT + '.json')]  # only the name is used
+            try:
+                with open(checkpoint_path, encoding='utf-8') as file:
+                    checkpoint = json.load(file)
+            except (OSError, ValueError) as err:
+                logging.warning('CONV INVALID CHECKPOINT %s: %s', checkpoint_path, err)
+                self.discard_checkpoint(source)
+                continue
+            if not self.resume:
+                logging.info('CONV SKIP CHECKPOINT %s (no resume)', checkpoint_path)
+                self.discard_checkpoint(source)
+                continue
+            settings = (self.conf_hash, self.n_iter, self.save_steps, self.output_fmt)
+            if settings != (checkpoint['conf_hash'], checkpoint['n_iter'],
+                            checkpoint['save_steps'], checkpoint['output_fmt']):
+                logging.info('CONV SKIP CHECKPOINT %s (different settings)', checkpoint_path)
+                self.discard_checkpoint(source)
+                continue
+            checkpoints.append((os.path.getmtime(checkpoint_path), checkpoint))
+        checkpoints = [c for dummy_mtime, c in sorted(checkpoints, key=lambda x: x[0])]
+        for checkpoint in checkpoints[:-1]:
+            self.discard_checkpoint(checkpoint['source'])
+        return checkpoints[-1] if checkpoints else None
+
+    def discard_checkpoint(self, filepath):
+        """Remove checkpoint that is not resumed, and let retention delete its sequence."""
+        self.remove_checkpoint(filepath)
+        self.notify('cancel', filepath)
+
+    def restore_checkpoint(self, checkpoint):
+        """Restore state of a sequence from checkpoint.
+
+        Returns:
+            image array after the last completed step
+        """
+        filepath = checkpoint['source']
+        im_array = np.load(os.path.join(self.path, checkpoint['data'])).astype(float)
+        np_state = checkpoint['np_random_state']
+        np.random.set_state((np_state[0], np.array(np_state[1], dtype=np.uint32)) +
+                            tuple(np_state[2:]))
+        py_state = checkpoint['random_state']
+        random.setstate((py_state[0], tuple(py_state[1]), py_state[2]))
+        self.imagelist = list(checkpoint['imagelist'])
+        self.save_steps_run = checkpoint.get('save_steps_run', self.save_steps)
+        if self.output_fmt == FRAMESTORE_FORMAT:
+            # discard frames appended after the checkpoint was written
+            storepath = self.get_output_filename(filepath)
+            self.framestores[storepath] = FrameStore(storepath, mode='r+')
+            self.framestores[storepath].truncate(len(self.imagelist))
+        self.notify('resume', filepath)
+        return im_array
+
+    def remove_checkpoint(self, filepath, keep=None):
+        """Remove checkpoint files of source image.
+
+        Args:
+            filepath (str): path of the source image
+            keep (str, optional): only remove image data files other than this one
+        """
+        checkpoint_path = self.get_checkpoint_filename(filepath)
+        filepaths = glob.glob(glob.escape(checkpoint_path) + '-*.npy')
+        if keep:
+            filepaths = [f for f in filepaths if f != keep]
+        else:
+            filepaths.append(checkpoint_path + '.json')
+        for filepath_remove in filepaths:
+            if os.path.exists(filepath_remove):
+                os.remove(filepath_remove)
+
     def stop(self):
         """Stop the thread."""
         super().stop()
         self.queue_in.put(None)  # break busy waiting
 
 
+    def notify(self, event, filepath, filepath_out=None):
+        """Report sequence progress to the retention manager.
+
+        Args:
+            event (str): one of ``start``, ``resume``, ``frame``, ``done``, ``cancel``
+            filepath (str): path of the source image
+            filepath_out (str, optional): path of the new frame
+        """
+        if self.queue_retention:
+            self.queue_retention.put((event, os.path.basename(filepath), filepath_out))
+
     def link_last_img(self, imgpath):
-        """Add link to final image to index.html."""
-        if not imgpath:
+        """Send final image to the gallery index."""
+        if not imgpath or not self.queue_gallery:
             return
         logging.info("CONV LINK %s", imgpath)
-        imgpath = os.path.basename(imgpath)
-        imgpath = imgpath.replace('\\', '/')
-        self.write_to_list_index('<img src="%s"></img>' % imgpath)
+        self.queue_gallery.put(imgpath)
 
-    def get_output_filename(self, filepath, i):
-        """Get filename for basename and index."""
+    def get_output_filename(self, filepath, i=None):
+        """Get filename for basename and index (no index for frame stores)."""
         filename = os.path.basename(filepath)
+        if i is None:
+            return os.path.join(self.path, '%s.%s' % (filename, self.output_fmt))
         path = os.path.join(self.path, '%s.%06d.%s' % (filename, i, self.output_fmt))
         return path
 
-    def write_to_list_index(self, text, append=True):
-        """Write text to index.html.
 
-        Args:
-            append (bool): create new file if False
-        """
-        with open(self.list_index, 'a' if append else 'w', encoding='utf-8') as file:
-            file.write(text)
+def get_conf_hash(conf):
+    """Get hash of filter configuration, to check if a checkpoint is compatible.
+
+    >>> get_conf_hash({'a': 1, 'b': 2}) == get_conf_hash({'b': 2, 'a': 1})
+    True
+    """
+    return hashlib.sha1(json.dumps(conf, sort_keys=True).encode()).hexdigest()
+
+
+def get_source(item):
+    """Split converter input item into path and image data (None if not in memory).
+
+    >>> get_source('a.png')
+    ('a.png', None)
+    """
+    if isinstance(item, tuple):
+        return item
+    return item, None
+
+
+def get_fast_noise_conf(conf):
+    """Get copy of filter configuration that uses precomputed noise fields.
+
+    >>> get_fast_noise_conf([{'name': 'noise', 'kwargs': {'cmax': 0.5}}])[0]['kwargs']
+    {'cmax': 0.5, 'bank_size': 8}
+    """
+    conf_fast = list()
+    for flt in conf:
+        if flt['name'] == 'noise' and not flt['kwargs'].get('bank_size'):
+            flt = dict(flt, kwargs=dict(flt['kwargs'], bank_size=ADAPT_NOISE_BANK_SIZE))
+        conf_fast.append(flt)
+    return conf_fast
 
 
 def main(source_image, temp_image_dir, **kwargs):
@@ -208,10 +549,13 @@ def main(source_image, temp_image_dir, **kwargs):
     n_iter = kwargs.get('iter', 1)
     save_steps = kwargs.get('save_steps', 1)
     output_fmt = kwargs.get('output_fmt', 'bmp')
+    output_opts = kwargs.get('output_opts')
     conv = Converter(queue_in=None, queue_out=None, path=temp_image_dir, conf=conf,
-                     n_iter=n_iter, save_steps=save_steps, output_fmt=output_fmt)
-    conv.run_on_image(source_image)
+                     n_iter=n_iter, save_steps=save_steps, output_fmt=output_fmt,
+                     output_opts=output_opts, resume=False, n_workers=kwargs.get('workers', 1))
+    conv.run_on_images(source_image, batch_size=kwargs.get('batch_size', 1))
 
 
 if __name__ == '__main__':
     main_setup(main, cmd_args=CMD_ARGS, default_loglevel='WARNING')
+
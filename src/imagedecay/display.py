@@ -4,19 +4,22 @@
 import logging
 import time
 
+import numpy as np
 from imagedecay.thread import MyThread
 
 
 class Display(MyThread):
     """Control the image display queue."""
-    def __init__(self, queue_in, queue_out, interval_s=1.0):
+    def __init__(self, queue_in, queue_out, interval_s=1.0, queue_stream=None):
         super().__init__()
         self.queue_in = queue_in
         self.queue_out = queue_out
+        self.queue_stream = queue_stream
         self.interval_s = interval_s
         self.wait_interval_s = 0.1
         self.image_list = list()
         self.image_queue = list()
+        self.sent_images = list()  # last images sent, may still be loaded by window or stream
         self.image_index = -1
         self.last_update = 0
         self.is_waiting = False
@@ -50,10 +53,89 @@ class Display(MyThread):
 
     def _send_next(self, img):
         self.is_waiting = False
+        self.sent_images = (self.sent_images + [img])[-2:]
         self.queue_out.put(img)
+        if self.queue_stream:
+            self.queue_stream.put(img)
         self.last_update = time.time()
 
     def stop(self):
         """Stop the thread."""
         super().stop()
         self.queue_in.put(None)  # break busy waiting
+
+
+class FrameBlender():
+    """Crossfade from the current frame to a new one in ``n_frames`` steps over ``duration_s``.
+
+    All frames are uint8 arrays (height, width, 3). The buffers are allocated once per
+    image size, and ``frame`` is updated in place, so a surface can be created on it once.
+    Only the in-between frames that are actually due are computed (when calling ``update``).
+
+    >>> blender = FrameBlender(n_frames=1, duration_s=1.0)
+    >>> blender.set_target(np.zeros((1, 1, 3), dtype=np.uint8), now=0)
+    True
+    >>> blender.set_target(np.full((1, 1, 3), 200, dtype=np.uint8), now=0)
+    False
+    >>> blender.update(now=0.6), int(blender.frame[0, 0, 0])
+    (True, 100)
+    >>> blender.update(now=1.0), int(blender.frame[0, 0, 0])
+    (True, 200)
+    """
+    def __init__(self, n_frames, duration_s):
+        self.n_steps = int(n_frames) + 1
+        self.step_s = float(duration_s) / self.n_steps
+        self.shape = None
+        self.frame = None  # current output frame
+        self.step = self.n_steps
+        self.start_time = 0
+
+    def set_target(self, im_array, now):
+        """Start blending from the current frame to a new image.
+
+        Args:
+            im_array (array): new image as uint8 (height, width, 3)
+            now (float): current time in s
+
+        Returns:
+            True if the buffers were (re)allocated (image size changed). In this case
+            the new image is shown without blending.
+        """
+        if im_array.shape != self.shape:
+            self.shape = im_array.shape
+            self.frame = np.empty(self.shape, dtype=np.uint8)
+            self._frame_from = np.empty(self.shape, dtype=np.uint8)
+            self._frame_to = np.empty(self.shape, dtype=np.uint8)
+            self._acc = np.empty(self.shape, dtype=np.uint16)
+            self._tmp = np.empty(self.shape, dtype=np.uint16)
+            np.copyto(self.frame, im_array)
+            self.step = self.n_steps
+            return True
+        np.copyto(self._frame_from, self.frame)  # start from what is shown now
+        np.copyto(self._frame_to, im_array)
+        self.start_time = now
+        self.step = 0
+        return False
+
+    def update(self, now):
+        """Compute the frame that is due at the given time.
+
+        Args:
+            now (float): current time in s
+
+        Returns:
+            True if the frame has changed
+        """
+        if self.step >= self.n_steps:
+            return False
+        step = min(self.n_steps, int((now - self.start_time) / self.step_s))
+        if step <= self.step:
+            return False
+        self.step = step
+        weight = np.uint16(256 * step // self.n_steps)  # fixed point, 8 bits
+        np.multiply(self._frame_from, np.uint16(256) - weight, out=self._acc)
+        np.multiply(self._frame_to, weight, out=self._tmp)
+        self._acc += self._tmp
+        self._acc >>= 8
+        np.copyto(self.frame, self._acc, casting='unsafe')
+        return True
@@ -5,10 +5,75 @@ import json
 import sys
 import logging
 import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy.ndimage.filters
 
+from imagedecay.readwrite import convert_to_float
+
+# filters that quantize their output, and the kwarg holding the number of levels
+QUANTIZING_FILTERS = {
+    'colordepth': 'n_colors'
+}
+GAUSS_TRUNCATE = 4.0  # scipy default: filter radius in standard deviations
+MIN_BAND_ROWS = 16
+NOISE_BLOCK_ROWS = 64  # noise is seeded per block of rows, independent of the bands
+
+_EXECUTOR = None  # thread pool for row bands (see set_workers)
+_N_WORKERS = 1
+
+
+def set_workers(n_workers):
+    """Set number of threads used to process row bands of an image in parallel.
+
+    NumPy and SciPy release the GIL in the heavy operations, so the filters of a
+    single image scale with the number of cores.
+
+    Args:
+        n_workers (int): number of threads, 1 to process the whole image at once
+    """
+    global _EXECUTOR, _N_WORKERS  # pylint: disable=global-statement
+    n_workers = max(1, int(n_workers or 1))
+    if n_workers == _N_WORKERS:
+        return
+    if _EXECUTOR:
+        _EXECUTOR.shutdown(wait=True)
+    _EXECUTOR = ThreadPoolExecutor(n_workers) if n_workers > 1 else None
+    _N_WORKERS = n_workers
+    logging.info('FILTER WORKERS %d', n_workers)
+
+
+def _as_batch(im_array):
+    """Get view of image array as stack of images (n_images, rows, cols, channels)."""
+    return im_array if im_array.ndim == 4 else im_array[np.newaxis]
+
+
+def _get_bands(n_rows, align=1):
+    """Split rows into (start, stop) bands, one per worker.
+
+    Band bounds (except the last) are multiples of ``align``.
+    """
+    n_blocks = (n_rows + align - 1) // align
+    n_bands = max(1, min(_N_WORKERS, n_rows // MIN_BAND_ROWS, n_blocks))
+    bounds = [min(n_rows, align * (n_blocks * i // n_bands)) for i in range(n_bands + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _run_bands(fun, n_rows, align=1):
+    """Call fun(start, stop) for all row bands, in parallel if workers are set.
+
+    Returns:
+        list of results by band
+    """
+    bands = _get_bands(n_rows, align)
+    if len(bands) == 1 or not _EXECUTOR:
+        return [fun(start, stop) for start, stop in bands]
+    futures = [_EXECUTOR.submit(fun, start, stop) for start, stop in bands]
+    return [f.result() for f in futures]
+
 
 def get_conf(filepath, encoding='utf-8'):
     """Read filter from config file.
@@ -36,22 +101,166 @@ def _get_filter_by_name(name):
     return fun
 
 
+def _get_lut_filter_by_name(name):
+    this = sys.modules[__name__]
+    funname = '_lut_%s' % name
+    fun = getattr(this, funname, None)
+    return fun
+
+
 def apply_filterconf(im_array, filterconf):
-    """Apply the given filter to the image array."""
-    for flt in filterconf:
-        im_array = _apply_filter(im_array, flt)
+    """Apply the given filter to the image array.
+
+    The image array can also be a stack of images of the same size (4 dimensions:
+    image, row, column, channel). All filters treat the images independently.
+
+    Quantized images (uint8 input, or the output of a quantizing filter like
+    ``colordepth``) are passed on as integer level arrays if the next filter is
+    pointwise and has a lookup table implementation (``_lut_<name>``). That filter
+    is then evaluated once per level and applied with a single lookup, instead of
+    once per pixel.
+    """
+    levels = 255 if im_array.dtype == np.uint8 else None
+    for i, flt in enumerate(filterconf):
+        next_lut = i + 1 < len(filterconf) and _get_lut_filter_by_name(filterconf[i + 1]['name'])
+        im_array, levels = _apply_filter(im_array, flt, levels, bool(next_lut))
+    if levels:
+        im_array = _from_levels(im_array, levels)
     return im_array
 
 
-def _apply_filter(im_array, filter_conf):
-    filter_fun = _get_filter_by_name(filter_conf['name'])
+def _apply_filter(im_array, filter_conf, levels=None, keep_levels=False):
+    name = filter_conf['name']
     filter_kwargs = filter_conf['kwargs']
-    logging.debug('FILTER %s: %s', filter_conf['name'], filter_kwargs)
-    im_array = filter_fun(im_array, **filter_kwargs)
-    return im_array
+    lut_fun = _get_lut_filter_by_name(name) if levels else None
+    if lut_fun:
+        logging.debug('FILTER %s (%d levels): %s', name, levels, filter_kwargs)
+        return lut_fun(im_array, levels, **filter_kwargs), None
+    logging.debug('FILTER %s: %s', name, filter_kwargs)
+    if levels:
+        im_array = _from_levels(im_array, levels)
+    if name in QUANTIZING_FILTERS and keep_levels:
+        levels = filter_kwargs[QUANTIZING_FILTERS[name]]
+        return _to_levels(im_array, levels), levels
+    return _get_filter_by_name(name)(im_array, **filter_kwargs), None
+
+
+def _to_levels(im_array, levels):
+    """Quantize float image array to integer levels (0 for 0.0, levels for 1.0)."""
+    im_array = im_array * levels
+    np.rint(im_array, out=im_array)
+    return im_array.astype(np.intp)
+
 
+def _from_levels(im_array, levels):
+    """Convert integer levels back to float image array."""
+    if im_array.dtype == np.uint8 and levels == 255:
+        return convert_to_float(im_array)
+    return im_array / levels
+
+
+class NoiseBank():
+    """Cache of precomputed (blurred) noise fields.
+
+    Fields are created once per (shape, cmin, cmax, gauss_sigma), blurred with
+    periodic boundaries so they can be shifted around seamlessly. Each sample is
+    a random field with random toroidal offset, flips and channel order.
+    If the total size exceeds ``max_bytes``, the least recently used fields are dropped.
+    """
+    def __init__(self):
+        self.fields = OrderedDict()
+        self.lock = threading.Lock()
 
-def filter_noise(im_array, cmin=0.0, cmax=1.0, gauss_sigma=1.0, **dummy_kwargs):
+    def sample(self, shape, cmin, cmax, gauss_sigma, size, max_bytes):
+        """Get a noise field.
+
+        Args:
+            shape (tuple): shape of image array
+            cmin (float): minimum noise
+            cmax (float): maximum noise
+            gauss_sigma (float): standard deviation for gauss filter.
+            size (int): number of precomputed fields
+            max_bytes (int): memory limit for all fields
+        """
+        key = (tuple(shape[-3:]), cmin, cmax, gauss_sigma)
+        with self.lock:
+            fields = self.fields.get(key)
+            if fields is None:
+                field_bytes = int(np.prod(key[0])) * np.dtype(np.float32).itemsize
+                size = max(1, min(size, max_bytes // field_bytes))
+                logging.info('FILTER NOISE BANK %s x %d', key, size)
+                fields = [_get_noise(key[0], cmin, cmax, gauss_sigma, mode='wrap')
+                          .astype(np.float32) for dummy_i in range(size)]
+                self.fields[key] = fields
+                self._limit(max_bytes)
+            self.fields.move_to_end(key)
+        if len(shape) == 4:  # stack of images
+            return np.stack([self.sample(shape[1:], cmin, cmax, gauss_sigma, size, max_bytes)
+                             for dummy_i in range(shape[0])])
+        field = random.choice(fields)
+        if random.random() < 0.5:
+            field = field[::-1]
+        if random.random() < 0.5:
+            field = field[:, ::-1]
+        offsets = (random.randrange(shape[0]), random.randrange(shape[1]))
+        field = np.roll(field, offsets, axis=(0, 1))
+        if len(shape) > 2:
+            field = field[..., np.random.permutation(shape[2])]
+        return field
+
+    def _limit(self, max_bytes):
+        """Drop least recently used fields until the total size is below max_bytes."""
+        while len(self.fields) > 1 and sum(f[0].nbytes * len(f) for f in
+                                           self.fields.values()) > max_bytes:
+            key, dummy_fields = self.fields.popitem(last=False)
+            logging.info('FILTER NOISE BANK DROP %s', key)
+
+
+_NOISE_BANK = NoiseBank()
+
+
+def _get_noise(shape, cmin, cmax, gauss_sigma, mode='nearest'):
+    """Create noise field, drawn from a seed taken from the global numpy state.
+
+    Every block of ``NOISE_BLOCK_ROWS`` rows has its own generator, so the result
+    does not depend on the number of workers.
+
+    >>> np.random.seed(1)
+    >>> noise_1 = _get_noise((200, 3, 3), 0.0, 1.0, 1.0)
+    >>> set_workers(4)
+    >>> np.random.seed(1)
+    >>> noise_4 = _get_noise((200, 3, 3), 0.0, 1.0, 1.0)
+    >>> set_workers(1)
+    >>> bool(np.array_equal(noise_1, noise_4))
+    True
+    """
+    rnd = np.empty(shape)
+    rnd_batch = _as_batch(rnd)
+    seed = np.random.randint(2 ** 31)  # keeps results reproducible from the global state
+
+    def _noise_band(start, stop):
+        band = rnd_batch[:, start:stop]
+        for block_start in range(start, stop, NOISE_BLOCK_ROWS):
+            rng = np.random.default_rng((seed, block_start))
+            for image in rnd_batch:  # output must be contiguous
+                rng.random(out=image[block_start:min(stop, block_start + NOISE_BLOCK_ROWS)])
+        band *= 2.0
+        band -= 1.0
+        sign = np.sign(band)
+        band *= cmax - cmin
+        sign *= cmin
+        band += sign
+    _run_bands(_noise_band, rnd_batch.shape[1], align=NOISE_BLOCK_ROWS)
+    if gauss_sigma:
+        if mode == 'wrap':  # periodic in x and y only (single image, not banded)
+            mode = ['wrap', 'wrap'] + ['nearest'] * (len(shape) - 2)
+            return scipy.ndimage.filters.gaussian_filter(rnd, sigma=gauss_sigma, mode=mode)
+        rnd = filter_gaussian(rnd, sigma=gauss_sigma)
+    return rnd
+
+
+def filter_noise(im_array, cmin=0.0, cmax=1.0, gauss_sigma=1.0, bank_size=0, bank_max_mb=256,
+                 **dummy_kwargs):
     """Apply random noise and optional gaussian blur after that.
 
     Args:
@@ -59,15 +268,25 @@ def filter_noise(im_array, cmin=0.0, cmax=1.0, gauss_sigma=1.0, **dummy_kwargs):
         cmin (float): minimum noise, defaults to 0.0
         cmax (float): maximum noise, defaults to 0.0
         gauss_sigma (float): standard deviation for gauss filter.
+        bank_size (int): if set, use this many precomputed noise fields
+            (randomly shifted, flipped and permuted) instead of creating new noise
+            in every call. Much faster, visually equivalent.
+        bank_max_mb (float): memory limit for precomputed noise fields
     """
-    rnd = np.random.rand(*im_array.shape)
-    rnd = rnd * 2.0 - 1.0
-    rnd = rnd * (cmax - cmin) + cmin * np.sign(rnd)
-    if gauss_sigma:
-        rnd = filter_gaussian(rnd, sigma=gauss_sigma)
-    im_array = im_array + rnd
-    im_array = im_array.clip(0.0, 1.0)  # clip
-    return im_array
+    if bank_size:
+        rnd = _NOISE_BANK.sample(im_array.shape, cmin, cmax, gauss_sigma, int(bank_size),
+                                 int(bank_max_mb * 1e6))
+    else:
+        rnd = _get_noise(im_array.shape, cmin, cmax, gauss_sigma)
+    im_array_out = np.empty(im_array.shape)
+    batch, rnd, batch_out = _as_batch(im_array), _as_batch(rnd), _as_batch(im_array_out)
+
+    def _noise_band(start, stop):
+        band = batch_out[:, start:stop]
+        np.add(batch[:, start:stop], rnd[:, start:stop], out=band)
+        np.clip(band, 0.0, 1.0, out=band)  # clip
+    _run_bands(_noise_band, batch.shape[1])
+    return im_array_out
 
 
 def filter_colordepth(im_array, n_colors, **dummy_kwargs):
@@ -77,8 +296,16 @@ def filter_colordepth(im_array, n_colors, **dummy_kwargs):
         im_array (array): image array
         n_colors (int): number of colors
     """
-    im_array = np.round(im_array * n_colors) / n_colors
-    return im_array
+    im_array_out = np.empty(im_array.shape)
+    batch, batch_out = _as_batch(im_array), _as_batch(im_array_out)
+
+    def _colordepth_band(start, stop):
+        band = batch_out[:, start:stop]
+        np.multiply(batch[:, start:stop], n_colors, out=band)
+        np.round(band, out=band)
+        band /= n_colors
+    _run_bands(_colordepth_band, batch.shape[1])
+    return im_array_out
 
 
 def filter_gaussian(im_array, sigma, **dummy_kwargs):
@@ -88,8 +315,20 @@ def filter_gaussian(im_array, sigma, **dummy_kwargs):
         im_array (array): image array
         sigma (float): standard deviation for gauss filter.
     """
-    im_array = scipy.ndimage.filters.gaussian_filter(im_array, sigma=sigma, mode='nearest')
-    return im_array
+    im_array_out = np.empty(im_array.shape)
+    batch, batch_out = _as_batch(im_array), _as_batch(im_array_out)
+    n_rows = batch.shape[1]
+    halo = int(GAUSS_TRUNCATE * float(np.max(sigma)) + 0.5)  # rows needed from neighbours
+    sigma = [0] + list(np.broadcast_to(sigma, (3,)))  # do not blur across images
+
+    def _gaussian_band(start, stop):
+        start_halo = max(0, start - halo)
+        stop_halo = min(n_rows, stop + halo)
+        band = scipy.ndimage.filters.gaussian_filter(batch[:, start_halo:stop_halo], sigma=sigma,
+                                                     mode='nearest', truncate=GAUSS_TRUNCATE)
+        batch_out[:, start:stop] = band[:, start - start_halo:stop - start_halo]
+    _run_bands(_gaussian_band, n_rows)
+    return im_array_out
 
 
 def filter_random_offset(im_array, alpha, max_x, max_y, **dummy_kwargs):
@@ -101,24 +340,29 @@ def filter_random_offset(im_array, alpha, max_x, max_y, **dummy_kwargs):
         max_x (float): max offset in x in percent of width
         max_y (float): max offset in y in percent of height
     """
-    def _shift_img(im_array_src, n_pixels, axis):
-        n_max_pixels = im_array_src.shape[axis]
-        shift_left = 0 if n_pixels < 0 else n_pixels
-        shift_right = n_max_pixels - (0 if n_pixels > 0 else -n_pixels)
-        shift = (n_pixels + n_max_pixels) % n_max_pixels
-        im_array_trgt = np.roll(im_array_src, shift, axis=axis)
-        slices1 = [slice(0, s) for s in im_array_src.shape]
-        slices1[axis] = slice(0, shift_left)
-        slices2 = [slice(0, s) for s in im_array_src.shape]
-        slices2[axis] = slice(shift_right, n_max_pixels)
-        im_array_trgt[slices1] = 0
-        im_array_trgt[slices2] = 0
-        return im_array_trgt
-    max_x = round((random.random() * 2.0 - 1.0) * max_x * im_array.shape[1])
-    max_y = round((random.random() * 2.0 - 1.0) * max_y * im_array.shape[0])
-    im_array_shifted = _shift_img(_shift_img(im_array, max_y, 0), max_x, 1)
-    im_array = im_array * (1 - alpha) + im_array_shifted * alpha
-    return im_array
+    im_array_out = np.empty(im_array.shape)
+    batch, batch_out = _as_batch(im_array), _as_batch(im_array_out)
+    n_rows, n_cols = batch.shape[1:3]
+    offsets = list()  # different offsets for each image
+    for dummy_i in range(batch.shape[0]):
+        offset_x = round((random.random() * 2.0 - 1.0) * max_x * n_cols)
+        offset_y = round((random.random() * 2.0 - 1.0) * max_y * n_rows)
+        offsets.append((offset_x, offset_y))
+
+    def _offset_band(start, stop):
+        band = batch_out[:, start:stop]
+        np.multiply(batch[:, start:stop], 1 - alpha, out=band)
+        # target pixel (y, x) gets source pixel (y - offset_y, x - offset_x), or 0 if outside
+        for i, (offset_x, offset_y) in enumerate(offsets):
+            cols_trgt = slice(max(0, offset_x), min(n_cols, n_cols + offset_x))
+            cols_src = slice(max(0, -offset_x), min(n_cols, n_cols - offset_x))
+            start_trgt = min(max(start, offset_y), stop)
+            stop_trgt = max(min(stop, n_rows + offset_y), start_trgt)
+            if stop_trgt > start_trgt and cols_trgt.stop > cols_trgt.start:
+                shifted = batch[i, start_trgt - offset_y:stop_trgt - offset_y, cols_src] * alpha
+                band[i, start_trgt - start:stop_trgt - start, cols_trgt] += shifted
+    _run_bands(_offset_band, n_rows)
+    return im_array_out
 
 
 def filter_colorrange(im_array, power_0, power_1, cmin=None, cmax=None, **dummy_kwargs):
@@ -131,13 +375,84 @@ def filter_colorrange(im_array, power_0, power_1, cmin=None, cmax=None, **dummy_
         cmin (float): minimum color value
         cmax (float): maximum color value
     """
-    im_array = im_array ** (power_0 + (power_1 - power_0) * im_array)
-    a_min = np.min(im_array)
-    a_max = np.max(im_array)
+    im_array_out = np.empty(im_array.shape)
+    batch, batch_out = _as_batch(im_array), _as_batch(im_array_out)
+
+    def _power_band(start, stop):
+        band = batch_out[:, start:stop]
+        np.multiply(batch[:, start:stop], power_1 - power_0, out=band)
+        band += power_0
+        np.power(batch[:, start:stop], band, out=band)
+        return np.min(band, axis=(1, 2, 3)), np.max(band, axis=(1, 2, 3))
+    min_max = _run_bands(_power_band, batch.shape[1])
+    # rescale each image with its own min and max
+    a_min = np.min([x[0] for x in min_max], axis=0)[:, None, None, None]
+    a_max = np.max([x[1] for x in min_max], axis=0)[:, None, None, None]
     if cmin is None:
         cmin = a_min
     if cmax is None:
         cmax = a_max
-    im_array = (im_array - a_min) / (a_max - a_min) * (cmax - cmin) + cmin
-    return im_array
+    scale = (cmax - cmin) / (a_max - a_min)
+
+    def _rescale_band(start, stop):
+        band = batch_out[:, start:stop]
+        band -= a_min
+        band *= scale
+        band += cmin
+    _run_bands(_rescale_band, batch.shape[1])
+    return im_array_out
+
+
+def _lut_colorrange(im_array, levels, power_0, power_1, cmin=None, cmax=None, **dummy_kwargs):
+    """Lookup table version of ``filter_colorrange`` for quantized images.
+
+    Args:
+        im_array (array): integer levels
+        levels (float): number of levels (value of 1.0)
+
+    Gives the same result as ``filter_colorrange`` on the float image, after a
+    quantizing filter and for uint8 input:
+
+    >>> rng = np.random.default_rng(0)
+    >>> im_array = rng.random((2, 20, 30, 3))  # stack of two images
+    >>> conf = [{'name': 'colordepth', 'kwargs': {'n_colors': 16}},
+    ...         {'name': 'colorrange', 'kwargs': {'power_0': 1.2, 'power_1': 0.8}}]
+    >>> expected = filter_colorrange(filter_colordepth(im_array, 16), 1.2, 0.8)
+    >>> float(np.max(np.abs(apply_filterconf(im_array, conf) - expected))) < 1e-12
+    True
+    >>> im_uint8 = rng.integers(0, 256, (20, 30, 3), dtype=np.uint8)
+    >>> kwargs = {'power_0': 1.2, 'power_1': 0.8, 'cmin': 0.1, 'cmax': 0.9}
+    >>> expected = filter_colorrange(convert_to_float(im_uint8), **kwargs)
+    >>> result = apply_filterconf(im_uint8, [{'name': 'colorrange', 'kwargs': kwargs}])
+    >>> float(np.max(np.abs(result - expected))) < 1e-12
+    True
+    """
+    batch = _as_batch(im_array)
+    n_images, n_rows = batch.shape[:2]
+    min_max = _run_bands(lambda start, stop: (int(np.min(batch[:, start:stop])),
+                                              int(np.max(batch[:, start:stop]))), n_rows)
+    i_min = min(0, min(x[0] for x in min_max))  # no need to shift non-negative index
+    i_max = max(x[1] for x in min_max)
+    values = np.arange(i_min, i_max + 1) / levels
+    lut = values ** (power_0 + (power_1 - power_0) * values)
+    # rescale with min and max of the levels actually used in each image, like filter_colorrange
+    index = batch - i_min if i_min else batch
+    counts = _run_bands(lambda start, stop: [np.bincount(index[i, start:stop].ravel(),
+                                                         minlength=len(lut))
+                                             for i in range(n_images)], n_rows)
+    used = np.sum(counts, axis=0) > 0
+    luts = list()
+    for i in range(n_images):
+        a_min = np.min(lut[used[i]])
+        a_max = np.max(lut[used[i]])
+        lut_cmin = a_min if cmin is None else cmin
+        lut_cmax = a_max if cmax is None else cmax
+        luts.append((lut - a_min) / (a_max - a_min) * (lut_cmax - lut_cmin) + lut_cmin)
+    im_array_out = np.empty(im_array.shape)
+    batch_out = _as_batch(im_array_out)
 
+    def _lookup_band(start, stop):
+        for i in range(n_images):
+            np.take(luts[i], index[i, start:stop], out=batch_out[i, start:stop])
+    _run_bands(_lookup_band, n_rows)
+    return im_array_out
@@ -0,0 +1,241 @@
+# coding=utf-8
+"""Maintain the html gallery index of finished sequences."""
+
+import json
+import logging
+import os
+import re
+import time
+
+from skimage.transform import rescale
+from imagedecay.readwrite import FrameStore, read, write, write_atomic, get_format
+from imagedecay.readwrite import get_frame_ref, parse_frame_ref, FRAMESTORE_FORMAT
+from imagedecay.thread import MyThread
+
+PAGE_HEADER = ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+               '<link href="style.css" rel="stylesheet">\n</head>\n<body>\n')
+PAGE_FOOTER = '</body>\n</html>\n'
+
+
+class Gallery(MyThread):
+    """Keep an in-memory list of finished sequences and write it to paginated index pages.
+
+    Final images are received on the input queue, entries are removed by sending
+    ``('remove', imgpath)``. Thumbnails are created in this
+    thread, and the pages are rewritten atomically (write temp file, then rename)
+    whenever ``flush_batch`` new entries have arrived or ``flush_interval_s`` has
+    passed. Only pages that changed are written.
+    On start, the finished sequences of previous runs are read from the retention
+    manifest (see ``retention.Retention``), so they stay in the gallery.
+    """
+    def __init__(self, queue_in, path, index_name='index.html', page_size=100,
+                 flush_interval_s=5.0, flush_batch=10, thumb_size=(320, 240), thumb_fmt='jpg',
+                 manifest_name='manifest.json'):
+        super().__init__()
+        self.queue_in = queue_in
+        self.path = path
+        self.index_name = index_name
+        self.page_size = max(1, int(page_size))
+        self.flush_interval_s = float(flush_interval_s)
+        self.flush_batch = max(1, int(flush_batch))
+        self.thumb_size = thumb_size
+        self.thumb_fmt = thumb_fmt
+        self.thumb_dir = 'thumbs'
+        self.manifest_path = os.path.join(path, manifest_name)
+        self.wait_interval_s = 0.1
+        self.entries = list()  # list of (file, link, thumbnail) relative to path
+        self.dirty_pages = set()
+        self.n_pending = 0
+        self.last_flush = time.time()
+
+    def run(self):
+        """Main thread."""
+        logging.info("GALL START")
+        self.load()
+        self.dirty_pages.update(range(self.get_n_pages()))  # always write (empty) first page
+        self.remove_obsolete_pages()
+        self.flush()
+        while self.running:
+            item = self.queue_in.get_first_nowait()
+            if item:
+                self.handle(item)
+            else:
+                time.sleep(self.wait_interval_s)
+            if self.n_pending >= self.flush_batch or (
+                    self.n_pending and time.time() - self.last_flush > self.flush_interval_s):
+                self.flush()
+        # drain remaining entries
+        item = self.queue_in.get_first_nowait()
+        while item:
+            self.handle(item)
+            item = self.queue_in.get_first_nowait()
+        self.flush()
+        logging.info("GALL STOP")
+
+    def handle(self, item):
+        """Handle item from input queue."""
+        if isinstance(item, tuple) and item[0] == 'remove':
+            self.remove(item[1])
+        elif isinstance(item, str):
+            self.add(item)
+
+    def load(self):
+        """Add finished sequences from the retention manifest, oldest first.
+
+        Existing thumbnails are used again.
+        """
+        if not os.path.exists(self.manifest_path):
+            return
+        with open(self.manifest_path, encoding='utf-8') as file:
+            sequences = json.load(file)
+        for dummy_time, filename in sorted((seq['time'], seq['files'][-1])
+                                           for seq in sequences.values()
+                                           if seq['status'] == 'done' and seq['files']):  # STATUS_DONE
+            imgpath = os.path.join(self.path, filename)
+            if get_format(imgpath) == FRAMESTORE_FORMAT:
+                try:
+                    imgpath = get_frame_ref(imgpath, len(FrameStore(imgpath)) - 1)
+                except Exception as err:
+                    logging.warning('GALL LOAD FAILED %s: %s', imgpath, err)
+                    continue
+            self.add(imgpath, reuse_thumbnail=True)
+
+    def add(self, imgpath, reuse_thumbnail=False):
+        """Add final image of a sequence.
+
+        Args:
+            imgpath (str): path to image
+            reuse_thumbnail (bool, optional): do not create thumbnail again if it exists
+        """
+        frame_ref = parse_frame_ref(imgpath)
+        self.remove(frame_ref[0] if frame_ref else imgpath)  # same sequence converted again
+        logging.info("GALL ADD %s", imgpath)
+        thumbpath = self.create_thumbnail(imgpath, reuse=reuse_thumbnail)
+        if frame_ref:  # frame stores cannot be shown by browsers
+            filepath, linkpath = frame_ref[0], thumbpath
+        else:
+            filepath = linkpath = imgpath
+        self.entries.append((self.get_relpath(filepath), self.get_relpath(linkpath),
+                             self.get_relpath(thumbpath)))
+        page = (len(self.entries) - 1) // self.page_size
+        self.dirty_pages.add(page)
+        if page > 0 and len(self.entries) % self.page_size == 1 % self.page_size:
+            self.dirty_pages.add(page - 1)  # new page: update link on previous one
+        self.n_pending += 1
+
+    def remove(self, imgpath):
+        """Remove image (and its thumbnail) from the gallery.
+
+        Args:
+            imgpath (str): path to image or frame store
+        """
+        relpath = self.get_relpath(imgpath)
+        for index, (entry_path, dummy_link_path, thumb_path) in enumerate(self.entries):
+            if entry_path == relpath:
+                break
+        else:
+            return
+        logging.info("GALL REMOVE %s", imgpath)
+        del self.entries[index]
+        if thumb_path != entry_path:
+            try:
+                os.remove(os.path.join(self.path, thumb_path))
+            except OSError:
+                pass
+        # all following entries move, and the last page may have disappeared
+        n_pages = self.get_n_pages()
+        self.dirty_pages.update(range(index // self.page_size, n_pages))
+        if len(self.entries) % self.page_size == 0 and self.entries:
+            obsolete = os.path.join(self.path, self.get_page_name(n_pages))
+            if os.path.exists(obsolete):
+                os.remove(obsolete)
+        self.n_pending += 1
+
+    def create_thumbnail(self, imgpath, reuse=False):
+        """Write a downscaled copy of the image into the thumbnail directory.
+
+        Args:
+            imgpath (str): path to image
+            reuse (bool, optional): keep an existing thumbnail
+
+        Returns:
+            path to thumbnail, or the image path itself if no thumbnail was created
+        """
+        if not self.thumb_size:
+            return imgpath
+        thumb_dir = os.path.join(self.path, self.thumb_dir)
+        thumbname = os.path.basename(imgpath).replace('#', '.')  # frame reference
+        thumbpath = os.path.join(thumb_dir, '%s.%s' % (thumbname, self.thumb_fmt))
+        if reuse and os.path.exists(thumbpath):
+            return thumbpath
+        try:
+            im_array, dummy_meta = read(imgpath)
+            scale = min(self.thumb_size[0] / im_array.shape[1],
+                        self.thumb_size[1] / im_array.shape[0], 1.0)
+            if scale < 1.0:
+                im_array = rescale(im_array, scale, mode='constant', channel_axis=2)
+            os.makedirs(thumb_dir, exist_ok=True)
+            write(im_array, thumbpath)
+        except Exception as err:
+            logging.warning('GALL THUMBNAIL FAILED %s: %s', imgpath, err)
+            return imgpath
+        return thumbpath
+
+    def get_relpath(self, filepath):
+        """Get path relative to gallery directory, with forward slashes."""
+        return os.path.relpath(filepath, self.path).replace('\\', '/')
+
+    def get_page_name(self, page):
+        """Get filename of page (0 based)."""
+        if page == 0:
+            return self.index_name
+        name, ext = os.path.splitext(self.index_name)
+        return '%s.%d%s' % (name, page + 1, ext)
+
+    def get_n_pages(self):
+        """Get current number of pages."""
+        return max(1, (len(self.entries) + self.page_size - 1) // self.page_size)
+
+    def remove_obsolete_pages(self):
+        """Delete pages after the last one (left from previous runs)."""
+        name, ext = os.path.splitext(self.index_name)
+        pattern = re.compile(r'^%s\.(\d+)%s$' % (re.escape(name), re.escape(ext)))
+        n_pages = self.get_n_pages()
+        for filename in os.listdir(self.path):
+            match = pattern.match(filename)
+            if match and int(match.group(1)) > n_pages:
+                logging.debug("GALL REMOVE PAGE %s", filename)
+                os.remove(os.path.join(self.path, filename))
+
+    def render_page(self, page):
+        """Create html for one page."""
+        lines = [PAGE_HEADER]
+        for dummy_path, linkpath, thumbpath in self.entries[page * self.page_size:
+                                                            (page + 1) * self.page_size]:
+            lines.append('<a href="%s"><img src="%s" loading="lazy"></a>\n' % (linkpath, thumbpath))
+        n_pages = self.get_n_pages()
+        if n_pages > 1:  # only links to neighbours, so adding a page changes only the last one
+            lines.append('<p class="nav">\n')
+            if page > 0:
+                lines.append('<a href="%s">&lt;</a>\n' % self.get_page_name(page - 1))
+            lines.append('%d\n' % (page + 1))
+            if page < n_pages - 1:
+                lines.append('<a href="%s">&gt;</a>\n' % self.get_page_name(page + 1))
+            lines.append('</p>\n')
+        lines.append(PAGE_FOOTER)
+        return ''.join(lines)
+
+    def flush(self):
+        """Write all changed pages."""
+        for page in sorted(self.dirty_pages):
+            filepath = os.path.join(self.path, self.get_page_name(page))
+            logging.debug("GALL WRITE %s", filepath)
+            write_atomic(self.render_page(page), filepath)
+        self.dirty_pages = set()
+        self.n_pending = 0
+        self.last_flush = time.time()
+
+    def stop(self):
+        """Stop the thread."""
+        super().stop()
+        self.queue_in.put(None)  # break busy waiting
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Run the complete pipeline headless against generated input images and measure it.
+
+The window uses SDL's dummy video driver. A generator drops images at a fixed
+rate into the input directory, the pipeline events (from a probe queue) are collected,
+and a json summary with latencies, throughput and resource use is written.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # before pygame is initialized
+
+import numpy as np
+import pygame as pyg
+from imagedecay import main as pipeline
+from imagedecay.readwrite import encode
+from imagedecay.thread import MyThread, MyQueue, MyProcessQueue, main_setup
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+DROP_NAME = 'load.%06d.jpg'
+DROP_PATTERN = re.compile(r'(load\.\d{6}\.jpg)')
+
+CMD_ARGS = [  # list of pairs of (args_tuple, kwargs_dict)
+    (['work_dir'], {
+        'help': 'path for input and output images (subdirectories in, out)',
+        'type': str
+    }),
+    (['--rate'], {
+        'help': 'generated images per s',
+        'default': 0.5,
+        'type': float
+    }),
+    (['--duration_s'], {
+        'help': 'time to generate images in s',
+        'default': 30.0,
+        'type': float
+    }),
+    (['--drain_s'], {
+        'help': 'time to keep running after the last image in s',
+        'default': 10.0,
+        'type': float
+    }),
+    (['--sizes'], {
+        'help': 'comma separated sizes of generated images (chosen randomly)',
+        'default': '1920x1080'
+    }),
+    (['--summary'], {
+        'help': 'path for json summary (default: print)'
+    })
+] + [arg for arg in pipeline.CMD_ARGS if arg[0][0] not in ('image_dir', 'temp_image_dir')]
+
+
+class DropGenerator(MyThread):
+    """Write images into a directory at a fixed rate.
+
+    Images of each size are encoded once, so generating them costs little time.
+    Files are written under a temporary name and renamed, so the scanner never sees
+    partial files.
+    """
+    def __init__(self, path, rate, sizes, duration_s):
+        super().__init__()
+        self.path = path
+        self.interval_s = 1.0 / rate
+        self.duration_s = duration_s
+        self.images = [encode(get_test_image(width, height)) for width, height in sizes]
+        self.drops = list()  # list of (time, name)
+
+    def run(self):
+        """Main thread."""
+        logging.info("LOAD START")
+        time_start = time.time()
+        while self.running and time.time() - time_start < self.duration_s:
+            name = DROP_NAME % len(self.drops)
+            filepath = os.path.join(self.path, name)
+            with open(filepath + '.tmp', 'wb') as file:
+                file.write(self.images[np.random.randint(len(self.images))])
+            os.replace(filepath + '.tmp', filepath)
+            self.drops.append((time.time(), name))
+            time_next = time_start + len(self.drops) * self.interval_s
+            time.sleep(max(0.0, time_next - time.time()))
+        logging.info("LOAD STOP (%d images)", len(self.drops))
+
+
+def get_test_image(width, height):
+    """Create smooth test image (compresses like a photo, unlike noise)."""
+    x_px, y_px = np.meshgrid(np.linspace(0, 1, width), np.linspace(0, 1, height))
+    return np.dstack([x_px, y_px, (np.sin(x_px * 20) * np.cos(y_px * 15) + 1) / 2])
+
+
+def get_stats(values):
+    """Get count and percentiles.
+
+    >>> get_stats([1.0, 2.0, 3.0])['p50']
+    2.0
+    """
+    if not values:
+        return {'n': 0}
+    return {'n': len(values), 'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)), 'p99': float(np.percentile(values, 99)),
+            'max': float(np.max(values))}
+
+
+def summarize(drops, events, time_start, time_end):
+    """Compute latencies, rates and backlog from drops and pipeline events.
+
+    Args:
+        drops (list): list of (time, name) of generated images
+        events (list): list of (time, event, path or name) from the probe queue
+        time_start (float): start of the test
+        time_end (float): end of the test
+
+    Returns:
+        summary dict
+
+    >>> drops = [(0.0, 'load.000000.jpg'), (1.0, 'load.000001.jpg'), (2.0, 'load.000002.jpg')]
+    >>> events = [(0.5, 'start', 'load.000000.jpg'), (1.5, 'show', 'load.000000.jpg.000000.bmp'),
+    ...           (3.0, 'skip', 'in/load.000001.jpg'), (3.0, 'start', 'load.000002.jpg'),
+    ...           (4.0, 'cancel', 'load.000000.jpg'), (6.0, 'done', 'load.000002.jpg')]
+    >>> summary = summarize(drops, events, 0.0, 10.0)
+    >>> summary['skipped'], summary['canceled'], summary['done'], summary['backlog']
+    (1, 1, 1, {'max': 1, 'end': 0})
+    >>> summary['first_frame_s']['max'], summary['done_s']['max']
+    (1.5, 4.0)
+    """
+    time_drop = {name: time_drop for time_drop, name in drops}
+    time_first = dict()
+    time_seq = {'start': dict(), 'done': dict(), 'cancel': dict()}
+    skipped = dict()
+    n_shown = 0
+    for event_time, event, path in events:
+        match = DROP_PATTERN.search(os.path.basename(str(path)))
+        name = match.group(1) if match else None
+        if event == 'show':
+            n_shown += 1
+            if name:
+                time_first.setdefault(name, event_time)
+        elif event == 'skip' and name:
+            skipped[name] = event_time
+        elif event in time_seq:
+            time_seq[event][path] = event_time
+    # earlier sources not yet started or skipped, at the time of each drop
+    handled = sorted(list(time_seq['start'].values()) + list(skipped.values()))
+    backlog = [i - int(np.searchsorted(handled, drop_time, side='right'))
+               for i, (drop_time, dummy_name) in enumerate(drops)]
+    duration_s = time_end - (drops[0][0] if drops else time_start)
+    n_started = len(time_seq['start'])
+    return {
+        'dropped': len(drops),
+        'skipped': len(skipped),
+        'started': n_started,
+        'canceled': len(time_seq['cancel']),
+        'done': len(time_seq['done']),
+        'cancel_rate': len(time_seq['cancel']) / n_started if n_started else None,
+        'first_frame_s': get_stats([t - time_drop[n] for n, t in time_first.items()
+                                    if n in time_drop]),
+        'done_s': get_stats([t - time_drop[n] for n, t in time_seq['done'].items()
+                             if n in time_drop]),
+        'throughput': {
+            'dropped_per_s': len(drops) / duration_s,
+            'done_per_s': len(time_seq['done']) / duration_s,
+            'frames_shown_per_s': n_shown / duration_s
+        },
+        'backlog': {'max': max(backlog, default=0), 'end': len(drops) - len(handled)}
+    }
+
+
+def get_resources(path):
+    """Get cpu time, peak memory (this and finished child processes) and size of files."""
+    n_bytes = sum(os.path.getsize(os.path.join(root, f))
+                  for root, dummy_dirs, files in os.walk(path) for f in files)
+    result = {'output_mb': n_bytes / 1e6}
+    if resource:
+        usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+                                                     resource.RUSAGE_CHILDREN)]
+        result['cpu_s'] = sum(u.ru_utime + u.ru_stime for u in usage)
+        result['max_rss_mb'] = max(u.ru_maxrss for u in usage) / 1024  # KB on Linux
+    return result
+
+
+def main(work_dir, **kwargs):
+    """Entry point for main script."""
+    image_dir = os.path.join(work_dir, 'in')
+    temp_image_dir = os.path.join(work_dir, 'out')
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(temp_image_dir, exist_ok=True)
+    sizes = [tuple(int(x) for x in size.split('x')) for size in kwargs['sizes'].split(',')]
+    # the scanner may run in the converter process
+    queue_probe = MyProcessQueue() if kwargs['process'] else MyQueue()
+    generator = DropGenerator(image_dir, kwargs['rate'], sizes, kwargs['duration_s'])
+
+    def control():
+        time.sleep(2.0)  # let the pipeline start
+        generator.start()
+        generator.join()
+        time.sleep(kwargs['drain_s'])
+        pyg.event.post(pyg.event.Event(pyg.QUIT))
+
+    time_start = time.time()
+    threading.Thread(target=control, daemon=True).start()
+    pipeline.main(image_dir=image_dir, temp_image_dir=temp_image_dir, queue_probe=queue_probe,
+                  **kwargs)
+    time_end = time.time()
+    events = list()
+    event = queue_probe.get_first_nowait()
+    while event:
+        events.append(event)
+        event = queue_probe.get_first_nowait()
+    summary = summarize(generator.drops, sorted(events), time_start, time_end)
+    summary['resources'] = get_resources(temp_image_dir)
+    summary['resources']['wall_s'] = time_end - time_start
+    if 'cpu_s' in summary['resources']:
+        summary['resources']['cpu_util'] = summary['resources']['cpu_s'] / (time_end - time_start)
+    summary['settings'] = {key: kwargs[key] for key in (
+        'rate', 'duration_s', 'sizes', 'iter', 'save_steps', 'display_interval_s',
+        'output_fmt', 'workers', 'process', 'process_scanner')}
+    text = json.dumps(summary, indent=1)
+    if kwargs['summary']:
+        with open(kwargs['summary'], 'w', encoding='utf-8') as file:
+            file.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main_setup(main, cmd_args=CMD_ARGS, default_loglevel='WARNING')
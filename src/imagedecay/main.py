@@ -1,20 +1,27 @@
 # coding=utf-8
 """Main script for the imagedecay package."""
 
+import json
 import logging
 import os
 import sys
 import time
 
+import numpy as np
 import pygame as pyg
-from pygame import camera
 from pygame.locals import QUIT, KEYDOWN, K_ESCAPE, K_RETURN
 
-from imagedecay.thread import MyThread, main_setup, MyQueue
+from imagedecay.thread import MyThread, main_setup, MyQueue, MyProcessQueue, ThreadProcess
+from imagedecay.readwrite import get_format, RAW_FORMATS, parse_frame_ref, read_frame
 from imagedecay.filter import get_conf
 from imagedecay.scanner import Scanner
-from imagedecay.display import Display
+from imagedecay.display import Display, FrameBlender
 from imagedecay.converter import Converter
+from imagedecay.gallery import Gallery
+from imagedecay.retention import Retention
+from imagedecay.capture import Capture, FakeCameraSource
+from imagedecay.stream import Stream
+from imagedecay.upload import Upload
 
 CMD_ARGS = [  # list of pairs of (args_tuple, kwargs_dict)
     (['image_dir'], {
@@ -52,6 +59,15 @@ CMD_ARGS = [  # list of pairs of (args_tuple, kwargs_dict)
         'default': 1.5,
         'type': float
     }),
+    (['--interpolate', '-k'], {
+        'help': 'number of blended frames shown between two images',
+        'default': 0,
+        'type': int
+    }),
+    (['--frame_budget_s'], {
+        'help': 'adapt noise, save steps and resolution to compute a frame within this time in s',
+        'type': float
+    }),
     (['--file_pattern', '-p'], {
         'help': 'scan file pattern',
         'default': r'^.*\.(jpg|png|jpeg|bmp)$',
@@ -61,21 +77,91 @@ CMD_ARGS = [  # list of pairs of (args_tuple, kwargs_dict)
         'help': 'Enable ENTER to take webcam snapshot (Linux only)',
         'action': 'store_true'
     }),
+    (['--no_cam_save'], {
+        'help': 'do not keep webcam snapshots (in image_dir/camera)',
+        'action': 'store_true'
+    }),
+    (['--fake_cam'], {
+        'help': 'use a test pattern instead of the webcam',
+        'action': 'store_true'
+    }),
     (['--output_fmt'], {
-        'help': 'output file format',
+        'help': 'output file format (bmp, png, jpg, webp, npy, frames)',
         'default': 'bmp'
+    }),
+    (['--output_opts'], {
+        'help': 'encoder settings as json, e.g. \'{"compress_level": 1}\'',
+        'type': json.loads
+    }),
+    (['--gallery_page_size'], {
+        'help': 'number of sequences per gallery index page',
+        'default': 100,
+        'type': int
+    }),
+    (['--workers', '-w'], {
+        'help': 'number of threads per image',
+        'default': 1,
+        'type': int
+    }),
+    (['--process'], {
+        'help': 'run the converter in a separate process',
+        'action': 'store_true'
+    }),
+    (['--process_scanner'], {
+        'help': 'also run the scanner in the converter process',
+        'action': 'store_true'
+    }),
+    (['--stream_port'], {
+        'help': 'stream the displayed images as MJPEG on this http port',
+        'type': int
+    }),
+    (['--upload_port'], {
+        'help': 'accept images by http POST on this port (kept in image_dir/upload)',
+        'type': int
+    }),
+    (['--upload_max_mb'], {
+        'help': 'maximum size of uploaded files in MB',
+        'default': 20.0,
+        'type': float
+    }),
+    (['--upload_interval_s'], {
+        'help': 'minimum time between accepted uploads in s (others get 429)',
+        'default': 10.0,
+        'type': float
+    }),
+    (['--no_resume'], {
+        'help': 'do not resume an interrupted sequence on startup',
+        'action': 'store_true'
+    }),
+    (['--keep_mb'], {
+        'help': 'delete oldest sequences if converted images exceed this size in MB',
+        'type': float
+    }),
+    (['--keep_hours'], {
+        'help': 'delete sequences older than this number of hours',
+        'type': float
+    }),
+    (['--keep_sequences'], {
+        'help': 'keep at most this number of sequences',
+        'type': int
     })
 ]
 
 
 class Window(MyThread):
-    """Output screen."""
-    def __init__(self, queue_in, path, image_screen_ratio=1.0, enable_cam=True):
+    """Output screen.
+
+    Shown images are also put on the optional probe queue as ``(time, 'show', imgpath)``.
+    """
+    def __init__(self, queue_in, path, image_screen_ratio=1.0, capture=None, interpolate=0,
+                 interval_s=1.0, queue_probe=None):
         super().__init__(daemon=False)
         self.queue_in = queue_in
+        self.queue_probe = queue_probe
         self.path = path
-        self.enable_cam = enable_cam
-        logging.error(self.enable_cam)
+        self.capture = capture
+        self.blender = FrameBlender(interpolate, interval_s) if interpolate else None
+        self.blend_surface = None
         pyg.init()
         winf = pyg.display.Info()
         self.window_width = int(winf.current_w * image_screen_ratio)
@@ -109,11 +195,13 @@ class Window(MyThread):
                     logging.info('USER QUIT')
                     self.running = False
                     break
-                elif self.enable_cam and err.type == KEYDOWN and err.key == K_RETURN:
-                    self.take_webcam_picture()
+                elif self.capture and err.type == KEYDOWN and err.key == K_RETURN:
+                    self.capture.trigger()
             img = self.queue_in.get_last_nowait()
             if img is not None:
                 self.display(img)
+            elif self.blender and self.blender.update(time.time()):
+                self.show(self.blend_surface)
         pyg.display.quit()
         logging.debug('WINDOW QUIT')
 
@@ -124,69 +212,156 @@ class Window(MyThread):
             imgpath (str): path to image
         """
         logging.info('WINDOW SHOW %s', imgpath)
+        if self.queue_probe:
+            self.queue_probe.put((time.time(), 'show', imgpath))
+        if not imgpath:
+            self.show(None)
+        elif self.blender:  # blend towards the new image, in-between frames follow in run()
+            if self.blender.set_target(self.load_array(imgpath), time.time()):
+                frame = self.blender.frame
+                self.blend_surface = pyg.image.frombuffer(frame, (frame.shape[1], frame.shape[0]),
+                                                          'RGB')
+                self.show(self.blend_surface)
+        elif parse_frame_ref(imgpath):  # surface uses the memory-mapped frame directly
+            frame = read_frame(imgpath)
+            self.show(pyg.image.frombuffer(frame, (frame.shape[1], frame.shape[0]), 'RGB'))
+        elif get_format(imgpath) in RAW_FORMATS:  # uint8 array (height, width, 3)
+            self.show(pyg.surfarray.make_surface(np.load(imgpath).swapaxes(0, 1)))
+        else:
+            self.show(pyg.image.load(imgpath))
+
+    def show(self, img):
+        """Show surface centered on the (cleared) screen.
+
+        Images computed at reduced resolution (see ``--frame_budget_s``) are scaled up
+        to fit the window.
+
+        Args:
+            img (Surface): image surface, or None to only clear the screen
+        """
         self.clear()
-        if imgpath:
-            img = pyg.image.load(imgpath)
+        if img is not None:
             img_width, img_height = img.get_rect().width, img.get_rect().height
+            if min(self.window_width - img_width, self.window_height - img_height) > 1:
+                scale = min(self.window_width / img_width, self.window_height / img_height)
+                img_width, img_height = int(img_width * scale), int(img_height * scale)
+                img = pyg.transform.smoothscale(img, (img_width, img_height))
             img_left = int((self.window_width - img_width) / 2)
             img_top = int((self.window_height - img_height) / 2)
             img_uppler_left = img_left, img_top
             self.surface.blit(img, img_uppler_left)
         pyg.display.flip()
 
+    @staticmethod
+    def load_array(imgpath):
+        """Load image as uint8 array (height, width, 3).
+
+        Args:
+            imgpath (str): path to image or frame reference
+        """
+        if parse_frame_ref(imgpath):
+            return read_frame(imgpath)
+        if get_format(imgpath) in RAW_FORMATS:
+            return np.load(imgpath)
+        return pyg.surfarray.array3d(pyg.image.load(imgpath)).swapaxes(0, 1)
+
     def clear(self):
         """Clear the screen."""
         self.surface.fill((0, 0, 0))
 
-    def take_webcam_picture(self):
-        """Take a picture with buildin webcam and put it in the input folder."""
-        camera.init()
-        cam = camera.Camera(pyg.camera.list_cameras()[0])
-        cam.start()
-        img = cam.get_image()
-        cam.stop()
-        cam_index = int(time.time() * 1000)
-        filepath = os.path.join(self.path, '_campic.%s.png' % cam_index)
-        logging.info('CAMPIC: %s', filepath)
-        pyg.image.save(img, filepath)
-        camera.quit()
-
 
 def main(**kwargs):    
-    """Entry point for the main script."""
+    """Entry point for the main script.
+
+    Pipeline events are put on ``kwargs['queue_probe']`` if given (see ``loadtest``),
+    it must be a MyProcessQueue if the converter runs in a separate process.
+    """
     image_dir = kwargs['image_dir']
     temp_image_dir = kwargs['temp_image_dir']
     assert image_dir != temp_image_dir
     assert os.path.exists(image_dir)
     assert os.path.exists(temp_image_dir)
-    list_index = os.path.join(temp_image_dir, 'index.html')
-    queue_scan = MyQueue()
-    queue_seq = MyQueue()
+    queue_class = MyProcessQueue if kwargs['process'] else MyQueue  # used by the converter
+    queue_scan = queue_class()
+    queue_seq = queue_class()
     queue_disp = MyQueue()
+    queue_gallery = queue_class()
+    queue_retention = queue_class()
+    queue_stream = MyQueue() if kwargs['stream_port'] else None
+    queue_probe = kwargs.get('queue_probe')
     conf = get_conf(kwargs['filterconf'])
+    capture = None
+    if kwargs['enable_cam']:  # pictures go to the converter directly, not via the scanner
+        capture = Capture(queue_out=queue_scan,
+                          path=None if kwargs['no_cam_save'] else os.path.join(image_dir, 'camera'),
+                          source=FakeCameraSource() if kwargs['fake_cam'] else None)
+    upload = None
+    if kwargs['upload_port']:  # images go to the converter directly, not via the scanner
+        upload = Upload(queue_out=queue_scan, port=kwargs['upload_port'],
+                        path=os.path.join(image_dir, 'upload'),
+                        max_bytes=kwargs['upload_max_mb'] * 1e6,
+                        min_interval_s=kwargs['upload_interval_s'])
     display = Display(queue_in=queue_seq, queue_out=queue_disp,
-                      interval_s=kwargs['display_interval_s'])
+                      interval_s=kwargs['display_interval_s'], queue_stream=queue_stream)
+    stream = Stream(queue_in=queue_stream, port=kwargs['stream_port']) if queue_stream else None
     window = Window(queue_in=queue_disp, path=image_dir,
                     image_screen_ratio=kwargs['image_screen_ratio'],
-                    enable_cam=kwargs['enable_cam'])
+                    capture=capture, interpolate=kwargs['interpolate'],
+                    interval_s=kwargs['display_interval_s'], queue_probe=queue_probe)
     max_image_size = (window.window_width, window.window_height)
-    scanner = Scanner(queue=queue_scan, path=image_dir, interval_s=kwargs['scan_interval_s'],
-                      file_pattern=kwargs['file_pattern'])
-    converter = Converter(queue_in=queue_scan, queue_out=queue_seq, path=temp_image_dir,
-                          conf=conf, n_iter=kwargs['iter'], save_steps=kwargs['save_steps'],
-                          max_image_size=max_image_size, output_fmt=kwargs['output_fmt'],
-                          list_index=list_index)
+    scanner_kwargs = dict(queue=queue_scan, path=image_dir, interval_s=kwargs['scan_interval_s'],
+                          file_pattern=kwargs['file_pattern'], queue_probe=queue_probe)
+    converter_kwargs = dict(queue_in=queue_scan, queue_out=queue_seq, path=temp_image_dir,
+                            conf=conf, n_iter=kwargs['iter'], save_steps=kwargs['save_steps'],
+                            max_image_size=max_image_size, output_fmt=kwargs['output_fmt'],
+                            output_opts=kwargs['output_opts'],
+                            queue_gallery=queue_gallery, queue_retention=queue_retention,
+                            resume=not kwargs['no_resume'], n_workers=kwargs['workers'],
+                            frame_budget_s=kwargs['frame_budget_s'])
+    if kwargs['process'] and kwargs['process_scanner']:
+        workers = [ThreadProcess([(Converter, converter_kwargs), (Scanner, scanner_kwargs)])]
+    elif kwargs['process']:
+        workers = [ThreadProcess([(Converter, converter_kwargs)]), Scanner(**scanner_kwargs)]
+    else:
+        workers = [Converter(**converter_kwargs), Scanner(**scanner_kwargs)]
+    gallery = Gallery(queue_in=queue_gallery, path=temp_image_dir,
+                      page_size=kwargs['gallery_page_size'])
+    retention = Retention(queue_in=queue_retention, path=temp_image_dir, display=display,
+                          queue_gallery=queue_gallery,
+                          max_bytes=kwargs['keep_mb'] and kwargs['keep_mb'] * 1e6,
+                          max_age_s=kwargs['keep_hours'] and kwargs['keep_hours'] * 3600,
+                          max_sequences=kwargs['keep_sequences'], queue_probe=queue_probe)
+    gallery.start()
+    retention.start()
     display.start()
-    converter.start()
-    scanner.start()
+    if capture:
+        capture.start()
+    if stream:
+        stream.start()
+    if upload:
+        upload.start()
+    for worker in workers:
+        worker.start()
     try:
         window.run()
     except KeyboardInterrupt:
         pass
     finally:
-        scanner.stop()
-        converter.stop()
+        for worker in reversed(workers):
+            worker.stop()  # processes wait until their threads have stopped
         display.stop()
+        if stream:
+            stream.stop()
+        if upload:
+            upload.stop()
+            upload.join(timeout=10.0)  # save pending originals
+        if capture:
+            capture.stop()
+            capture.join(timeout=10.0)  # save pending pictures
+        retention.stop()
+        retention.join(timeout=10.0)  # write manifest
+        gallery.stop()
+        gallery.join(timeout=10.0)  # write final index pages
 
 
 if __name__ == '__main__':
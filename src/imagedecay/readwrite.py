@@ -2,7 +2,11 @@
 """Read/write image files to numpy."""
 
 import logging
+import os
+import threading
+from collections import OrderedDict
 
+import imageio.v3 as iio
 import skimage
 import skimage.io
 import skimage.color
@@ -10,6 +14,22 @@ import numpy as np
 
 BG_COLOR_FLOAT = 1.0
 
+# default encoder settings by file extension, favouring speed over size.
+# keyword arguments are passed on to the imageio plugin (pillow)
+ENCODER_DEFAULTS = {
+    'png': {'compress_level': 1},
+    'jpg': {'quality': 90},
+    'jpeg': {'quality': 90},
+    'webp': {'quality': 90, 'method': 0},
+}
+RAW_FORMATS = ('npy',)
+FRAMESTORE_FORMAT = 'frames'
+FRAMESTORE_MAGIC = 0x53464449  # b'IDFS'
+FRAMESTORE_VERSION = 1
+FRAMESTORE_HEADER_SIZE = 8  # number of uint64 values
+FRAME_REF_SEP = '#'
+MAX_OPEN_STORES = 3  # frame stores kept mapped by read_frame
+
 
 def read(filepath):
     """Read image data from file.
@@ -21,10 +41,13 @@ def read(filepath):
         image array as float, metadata dict
     """
     logging.debug('READ image data from %s', filepath)
-    im_array = skimage.io.imread(filepath)
-    im_array = convert_to_float(im_array)
-    im_array = remove_alpha(im_array)
-    im_array = convert_from_greyscale(im_array)
+    if parse_frame_ref(filepath):
+        im_array = read_frame(filepath)
+    elif get_format(filepath) in RAW_FORMATS:
+        im_array = np.load(filepath)
+    else:
+        im_array = skimage.io.imread(filepath)
+    im_array = normalize(im_array)
     im_meta = {
         "filepath": filepath,
         "dtype": str(im_array.dtype),
@@ -35,16 +58,104 @@ def read(filepath):
     return im_array, im_meta
 
 
-def write(im_array, filepath):
+def normalize(im_array):
+    """Convert image data (e.g. from a camera) to float RGB, like ``read`` does."""
+    im_array = convert_to_float(im_array)
+    im_array = remove_alpha(im_array)
+    return convert_from_greyscale(im_array)
+
+
+def write(im_array, filepath, **encoder_kwargs):
     """Write image data to file.
 
+    The format is derived from the file extension. ``npy`` writes the raw uint8 array,
+    which is the fastest option for frames that are only used internally.
+
     Args:
         im_array (array): image data as float
         filepath (str): path to image file
+        encoder_kwargs: encoder settings, e.g. ``compress_level`` (png, 0-9),
+            ``quality`` (jpg, webp, 0-100), ``method`` (webp, 0-6), ``lossless`` (webp).
+            Defaults are taken from ``ENCODER_DEFAULTS``.
     """
     logging.debug('SAVE image data to %s', filepath)
     im_array = convert_to_int(im_array, clip=True)
-    skimage.io.imsave(filepath, im_array)
+    fmt = get_format(filepath)
+    if fmt in RAW_FORMATS:
+        with open(filepath, 'wb') as file:  # np.save(filepath) would add extension
+            np.save(file, im_array)
+        return
+    kwargs = dict(ENCODER_DEFAULTS.get(fmt, {}))
+    kwargs.update(encoder_kwargs)
+    if kwargs:
+        iio.imwrite(filepath, im_array, **kwargs)
+    else:
+        skimage.io.imsave(filepath, im_array)
+
+
+def encode(im_array, fmt='jpg', **encoder_kwargs):
+    """Encode image data in memory.
+
+    Args:
+        im_array (array): image data as float or uint8
+        fmt (str, optional): image format
+        encoder_kwargs: encoder settings (see ``write``)
+
+    Returns:
+        encoded image as bytes
+    """
+    if im_array.dtype != np.uint8:
+        im_array = convert_to_int(im_array, clip=True)
+    kwargs = dict(ENCODER_DEFAULTS.get(fmt, {}))
+    kwargs.update(encoder_kwargs)
+    return iio.imwrite('<bytes>', im_array, extension='.' + fmt, **kwargs)
+
+
+def write_atomic(text, filepath, encoding='utf-8'):
+    """Write text to a temporary file and rename it, so readers never see partial files.
+
+    Args:
+        text (str): file content
+        filepath (str): path to target file
+        encoding (str, optional): text encoding
+    """
+    filepath_tmp = filepath + '.tmp'
+    with open(filepath_tmp, 'w', encoding=encoding) as file:
+        file.write(text)
+    os.replace(filepath_tmp, filepath)
+
+
+class ImageTooLargeError(ValueError):
+    """Image has more pixels than allowed."""
+
+
+def decode(data, max_pixels=None):
+    """Decode image from memory.
+
+    Args:
+        data (bytes): encoded image
+        max_pixels (int, optional): refuse larger images (checked before decoding)
+
+    Returns:
+        image array as stored (usually uint8, see ``normalize``)
+
+    Raises:
+        ImageTooLargeError: image has more than ``max_pixels`` pixels
+    """
+    if max_pixels:
+        shape = iio.improps(data).shape
+        if shape[0] * shape[1] > max_pixels:
+            raise ImageTooLargeError('Image too large: %d x %d' % (shape[1], shape[0]))
+    return iio.imread(data)
+
+
+def get_format(filepath):
+    """Get image format (lower case file extension without dot).
+
+    >>> get_format('a/b.000001.PNG')
+    'png'
+    """
+    return os.path.splitext(filepath)[1].lstrip('.').lower()
 
 
 def remove_alpha(im_array, bg_color_float=BG_COLOR_FLOAT):
@@ -70,7 +181,7 @@ def remove_alpha(im_array, bg_color_float=BG_COLOR_FLOAT):
     im_array = im_array[:, :, :-1]
     # stack alpha:
     alpha = np.stack([alpha] * (n_channels - 1), axis=2)
-    background = np.ones(shape=im_array.shape, dtype=np.float) * bg_color_float
+    background = np.ones(shape=im_array.shape, dtype=float) * bg_color_float
     im_array = background * (1.0 - alpha) + im_array * alpha
     return im_array
 
@@ -91,7 +202,7 @@ def convert_to_float(im_array, clip=False):
     if 'int' not in str(im_array.dtype):
         logging.warning('Image does not seem to be int.')
         return im_array
-    im_array = im_array.astype(np.float) / 255.0
+    im_array = im_array.astype(float) / 255.0
     if clip:
         im_array = im_array.clip(0.0, 1.0)
     return im_array
@@ -107,3 +218,191 @@ def convert_to_int(im_array, clip=False):
         im_array = im_array.clip(0, 255)
     return im_array
 
+
+class FrameStore():
+    """Raw uint8 frames of one sequence in a single preallocated, memory-mapped file.
+
+    The file starts with a header of 8 uint64 values (magic, version, height,
+    width, channels, capacity, count, reserved), followed by ``capacity`` frames.
+    Appending a frame is a copy into the mapped file, reading returns a view
+    without copying. Single frames are referenced as ``<filepath>#<index>``
+    (see ``get_frame_ref``), which ``read`` understands.
+
+    >>> import tempfile
+    >>> tmp_dir = tempfile.TemporaryDirectory()
+    >>> path = os.path.join(tmp_dir.name, 'a.frames')
+    >>> store = FrameStore.create(path, (4, 4, 3), capacity=3)
+    >>> store.append(np.zeros((4, 4, 3))), store.append(np.full((4, 4, 3), 255, dtype=np.uint8))
+    (0, 1)
+    >>> store.flush()
+    >>> store = FrameStore(path, mode='r+')
+    >>> len(store), int(store[-1][0, 0, 0])
+    (2, 255)
+    >>> store.truncate(1)
+    >>> store.append(np.full((4, 4, 3), 1.0))
+    1
+    >>> read_frame(get_frame_ref(path, 1)).shape
+    (4, 4, 3)
+    >>> store = FrameStore.create(path, (8, 2, 3), capacity=1)  # new file, readers notice
+    >>> store.append(np.zeros((8, 2, 3)))
+    0
+    >>> read_frame(get_frame_ref(path, 0)).shape
+    (8, 2, 3)
+    >>> tmp_dir.cleanup()
+    """
+    def __init__(self, filepath, mode='r'):
+        """Open existing frame store.
+
+        Args:
+            filepath (str): path to store file
+            mode (str, optional): 'r' for read only or 'r+' to append
+        """
+        self.filepath = filepath
+        header = np.fromfile(filepath, dtype=np.uint64, count=FRAMESTORE_HEADER_SIZE)
+        if len(header) < FRAMESTORE_HEADER_SIZE or header[0] != FRAMESTORE_MAGIC:
+            raise Exception('Not a frame store: %s' % filepath)
+        if header[1] != FRAMESTORE_VERSION:
+            raise Exception('Unsupported frame store version: %d' % header[1])
+        self.shape = tuple(int(x) for x in header[2:5])
+        self.capacity = int(header[5])
+        self._mmap = np.memmap(filepath, dtype=np.uint8, mode=mode)
+        header_bytes = FRAMESTORE_HEADER_SIZE * 8
+        self._header = self._mmap[:header_bytes].view(np.uint64)
+        self._frames = self._mmap[header_bytes:].reshape((self.capacity,) + self.shape)
+
+    @classmethod
+    def create(cls, filepath, shape, capacity):
+        """Create new (empty) frame store, replacing an existing file.
+
+        The store is written to a temporary file and renamed, so readers that still
+        have the old file mapped keep it and ``read_frame`` notices the new inode.
+
+        Args:
+            filepath (str): path to store file
+            shape (tuple): shape of frames (height, width, channels)
+            capacity (int): maximum number of frames
+
+        Returns:
+            FrameStore opened for appending
+        """
+        header = np.zeros(FRAMESTORE_HEADER_SIZE, dtype=np.uint64)
+        header[0:6] = (FRAMESTORE_MAGIC, FRAMESTORE_VERSION) + tuple(shape) + (capacity,)
+        with open(filepath + '.tmp', 'wb') as file:
+            file.write(header.tobytes())
+            file.truncate(header.nbytes + int(np.prod(shape)) * capacity)  # preallocate
+        os.replace(filepath + '.tmp', filepath)
+        logging.debug('FRAMES CREATE %s %s x %d', filepath, shape, capacity)
+        return cls(filepath, mode='r+')
+
+    def __len__(self):
+        return int(self._header[6])
+
+    def __getitem__(self, index):
+        """Get frame as uint8 array (view into the file)."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._frames[index]
+
+    def append(self, im_array):
+        """Append frame.
+
+        Args:
+            im_array (array): image data as float or uint8
+
+        Returns:
+            index of the new frame
+        """
+        index = len(self)
+        if index >= self.capacity:
+            raise Exception('Frame store is full: %s' % self.filepath)
+        if im_array.dtype != np.uint8:
+            im_array = convert_to_int(im_array, clip=True)
+        self._frames[index] = im_array
+        self._header[6] = index + 1  # only count frame when it is complete
+        return index
+
+    def truncate(self, count):
+        """Discard all frames after the first ``count``."""
+        self._header[6] = min(count, len(self))
+
+    def flush(self):
+        """Write changes to disk."""
+        self._mmap.flush()
+
+
+def get_frame_ref(filepath, index):
+    """Get reference to a single frame in a frame store.
+
+    >>> get_frame_ref('a/b.frames', 3)
+    'a/b.frames#3'
+    """
+    return '%s%s%d' % (filepath, FRAME_REF_SEP, index)
+
+
+def parse_frame_ref(frame_ref):
+    """Split frame reference into path and index.
+
+    >>> parse_frame_ref('a/b.frames#3')
+    ('a/b.frames', 3)
+    >>> parse_frame_ref('a/b.png') is None
+    True
+
+    Returns:
+        tuple (filepath, index) or None if it is not a frame reference
+    """
+    filepath, sep, index = frame_ref.rpartition(FRAME_REF_SEP)
+    if not sep or get_format(filepath) != FRAMESTORE_FORMAT or not index.isdigit():
+        return None
+    return filepath, int(index)
+
+
+_OPEN_STORES = OrderedDict()  # by (path, inode), least recently used first
+_OPEN_STORES_LOCK = threading.Lock()
+
+
+def read_frame(frame_ref):
+    """Read single frame from a frame store without copying.
+
+    The last ``MAX_OPEN_STORES`` stores are kept open (per file path and inode).
+    Stores whose file was deleted or replaced are closed when another one is opened,
+    so their disk space is freed as soon as no frame of them is in use any more.
+
+    Args:
+        frame_ref (str): frame reference (``<filepath>#<index>``)
+
+    Returns:
+        image array as uint8 (read only view)
+
+    >>> import tempfile
+    >>> tmp_dir = tempfile.TemporaryDirectory()
+    >>> for i in range(5):
+    ...     path = os.path.join(tmp_dir.name, '%d.frames' % i)
+    ...     _ = FrameStore.create(path, (2, 2, 3), capacity=1).append(np.zeros((2, 2, 3)))
+    ...     _ = read_frame(get_frame_ref(path, 0))
+    >>> os.remove(path)
+    >>> sorted(os.path.basename(key[0]) for key in _OPEN_STORES)
+    ['2.frames', '3.frames', '4.frames']
+    >>> _ = read_frame(get_frame_ref(os.path.join(tmp_dir.name, '0.frames'), 0))
+    >>> sorted(os.path.basename(key[0]) for key in _OPEN_STORES)
+    ['0.frames', '2.frames', '3.frames']
+    >>> tmp_dir.cleanup()
+    """
+    filepath, index = parse_frame_ref(frame_ref)
+    key = filepath, os.stat(filepath).st_ino
+    with _OPEN_STORES_LOCK:
+        store = _OPEN_STORES.get(key)
+        if store is None:
+            for old_key in list(_OPEN_STORES):  # deleted or replaced
+                try:
+                    is_current = os.stat(old_key[0]).st_ino == old_key[1]
+                except FileNotFoundError:
+                    is_current = False
+                if not is_current:
+                    del _OPEN_STORES[old_key]
+            store = _OPEN_STORES[key] = FrameStore(filepath)
+            while len(_OPEN_STORES) > MAX_OPEN_STORES:
+                _OPEN_STORES.popitem(last=False)
+        _OPEN_STORES.move_to_end(key)
+    return store[index]
@@ -0,0 +1,283 @@
+# coding=utf-8
+"""Delete old output sequences to keep the temp image directory bounded."""
+
+import json
+import logging
+import os
+import re
+import time
+
+from imagedecay.converter import CHECKPOINT_EXT
+from imagedecay.readwrite import parse_frame_ref, write_atomic
+from imagedecay.thread import MyThread
+
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_CANCELED = 'canceled'
+STATUS_DELETING = 'deleting'
+
+
+class Retention(MyThread):
+    """Keep track of output sequences and delete whole sequences according to retention policies.
+
+    The converter reports events on the input queue as tuples ``(event, name, filepath)``
+    with event one of ``start``, ``resume``, ``frame``, ``done`` or ``cancel``. The known sequences
+    are kept in a manifest file, so the directory does not need to be rescanned on startup.
+    Canceled sequences are deleted one check interval after the cancel (their frames
+    may still be on the way to the display) if the display no longer uses them, finished
+    sequences when one of the limits (total bytes, age in seconds, number of sequences)
+    is exceeded, oldest first. Images the display might still show are never deleted.
+    The events are also put on the optional probe queue as ``(time, event, name)``.
+    """
+    def __init__(self, queue_in, path, display=None, queue_gallery=None, max_bytes=None,
+                 max_age_s=None, max_sequences=None, interval_s=10.0,
+                 manifest_name='manifest.json', queue_probe=None):
+        super().__init__()
+        self.queue_in = queue_in
+        self.queue_probe = queue_probe
+        self.path = path
+        self.display = display
+        self.queue_gallery = queue_gallery
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.max_sequences = max_sequences
+        self.interval_s = float(interval_s)
+        self.wait_interval_s = 0.1
+        self.manifest_path = os.path.join(path, manifest_name)
+        self.sequences = self.load_manifest()
+        self.manifest_changed = False
+        self.last_check = 0
+
+    def run(self):
+        """Main thread."""
+        logging.info("RETN START")
+        while self.running:
+            item = self.queue_in.get_first_nowait()
+            if item:
+                self.update(*item)
+                continue
+            if time.time() - self.last_check > self.interval_s:
+                self.apply_policies()
+                self.last_check = time.time()
+            if self.manifest_changed:
+                self.write_manifest()
+            time.sleep(self.wait_interval_s)
+        if self.manifest_changed:
+            self.write_manifest()
+        logging.info("RETN STOP")
+
+    def update(self, event, name, filepath=None):
+        """Update sequence information from converter event.
+
+        Args:
+            event (str): one of ``start``, ``resume``, ``frame``, ``done``, ``cancel``
+            name (str): name of the sequence
+            filepath (str, optional): path of new frame
+        """
+        logging.debug('RETN EVENT %s %s', event, name)
+        if self.queue_probe:
+            self.queue_probe.put((time.time(), event, name))
+        if event == 'start':
+            old_seq = self.sequences.get(name)
+            if old_seq and old_seq['status'] == STATUS_CANCELED:  # same files, not deleted yet
+                files, n_bytes = old_seq['files'], old_seq['bytes']
+            else:
+                files, n_bytes = [], 0
+            self.sequences[name] = {'status': STATUS_RUNNING, 'time': time.time(),
+                                    'bytes': n_bytes, 'files': files}
+        seq = self.sequences.get(name)
+        if not seq:
+            logging.warning('RETN UNKNOWN SEQUENCE %s', name)
+            return
+        if event == 'resume':
+            seq['status'] = STATUS_RUNNING
+        elif event == 'frame':
+            filename = os.path.basename(filepath)
+            if filename not in seq['files']:
+                seq['files'].append(filename)
+                seq['bytes'] += get_size(filepath)
+        elif event == 'done':
+            seq['status'] = STATUS_DONE
+            seq['bytes'] = sum(get_size(os.path.join(self.path, filename))  # frame stores grow
+                               for filename in seq['files'])
+        elif event == 'cancel':
+            seq['status'] = STATUS_CANCELED  # deleted by apply_policies
+            seq['time_canceled'] = time.time()
+        self.manifest_changed = True
+
+    def apply_policies(self):
+        """Delete canceled sequences, and oldest finished sequences until all limits are met.
+
+        >>> import tempfile, types
+        >>> from imagedecay.thread import MyQueue
+        >>> tmp_dir = tempfile.TemporaryDirectory()
+        >>> display = types.SimpleNamespace(image_list=[], image_queue=[], sent_images=[])
+        >>> retention = Retention(MyQueue(), tmp_dir.name, display=display, max_sequences=2)
+        >>> for name in ('a', 'b', 'c', 'd'):
+        ...     filepath = os.path.join(tmp_dir.name, name + '.000000.bmp')
+        ...     open(filepath, 'wb').close()
+        ...     for event in ('start', 'frame', 'done' if name != 'd' else 'cancel'):
+        ...         retention.update(event, name, filepath)
+        >>> display.image_list = [os.path.join(tmp_dir.name, 'a.000000.bmp')]  # oldest, but shown
+        >>> retention.apply_policies()  # d was canceled just now, its frames may still be queued
+        >>> sorted(retention.sequences), sorted(os.listdir(tmp_dir.name))
+        (['a', 'c', 'd'], ['a.000000.bmp', 'c.000000.bmp', 'd.000000.bmp', 'manifest.json'])
+        >>> retention.sequences['d']['time_canceled'] -= retention.interval_s
+        >>> retention.apply_policies()
+        >>> sorted(retention.sequences), sorted(os.listdir(tmp_dir.name))
+        (['a', 'c'], ['a.000000.bmp', 'c.000000.bmp', 'manifest.json'])
+        >>> tmp_dir.cleanup()
+        """
+        in_use = self.get_files_in_use()
+        for name in [name for name, seq in self.sequences.items()
+                     if seq['status'] == STATUS_CANCELED]:
+            if time.time() - self.sequences[name].get('time_canceled', 0) < self.interval_s:
+                continue
+            if in_use & set(self.sequences[name]['files']):
+                logging.debug('RETN KEEP %s (in use)', name)
+            else:
+                self.delete(name)
+        finished = sorted((seq['time'], name) for name, seq in self.sequences.items()
+                          if seq['status'] == STATUS_DONE)
+        n_sequences = len(finished)
+        total_bytes = sum(seq['bytes'] for seq in self.sequences.values())
+        for seq_time, name in finished:
+            too_many = self.max_sequences is not None and n_sequences > self.max_sequences
+            too_big = self.max_bytes is not None and total_bytes > self.max_bytes
+            too_old = self.max_age_s is not None and time.time() - seq_time > self.max_age_s
+            if not (too_many or too_big or too_old):
+                break  # all following sequences are newer
+            if in_use & set(self.sequences[name]['files']):
+                logging.debug('RETN KEEP %s (in use)', name)
+                continue
+            total_bytes -= self.sequences[name]['bytes']
+            n_sequences -= 1
+            self.delete(name)
+
+    def get_files_in_use(self):
+        """Get names of all images the display might still show."""
+        if not self.display:
+            return set()
+        images = (list(self.display.image_list) + list(self.display.image_queue)
+                  + list(self.display.sent_images))
+        images = [img for img in images if isinstance(img, str)]
+        images = [(parse_frame_ref(img) or (img,))[0] for img in images]
+        return set(os.path.basename(img) for img in images)
+
+    def delete(self, name):
+        """Delete all files of a sequence.
+
+        The sequence is first marked in the manifest, so an interrupted deletion
+        is completed on the next startup.
+        """
+        seq = self.sequences[name]
+        logging.info('RETN DELETE %s (%s, %d files)', name, seq['status'], len(seq['files']))
+        seq['status'] = STATUS_DELETING
+        self.write_manifest()
+        for filename in seq['files']:
+            filepath = os.path.join(self.path, filename)
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                logging.warning('RETN DELETE FAILED %s: %s', filepath, err)
+        if self.queue_gallery and seq['files']:
+            self.queue_gallery.put(('remove', os.path.join(self.path, seq['files'][-1])))
+        del self.sequences[name]
+        self.write_manifest()
+
+    def load_manifest(self):
+        """Read manifest, or scan the directory if there is none.
+
+        Unfinished sequences from a previous run are deleted,
+        unless the converter left a checkpoint to resume them.
+
+        >>> import tempfile
+        >>> from imagedecay.thread import MyQueue
+        >>> tmp_dir = tempfile.TemporaryDirectory()
+        >>> retention = Retention(MyQueue(), tmp_dir.name)
+        >>> for name, event in (('a', 'done'), ('b', 'frame')):
+        ...     filepath = os.path.join(tmp_dir.name, name + '.000000.bmp')
+        ...     open(filepath, 'wb').close()
+        ...     for event in ('start', 'frame', event):
+        ...         retention.update(event, name, filepath)
+        >>> retention.write_manifest()
+        >>> retention = Retention(MyQueue(), tmp_dir.name)  # b was interrupted
+        >>> sorted(retention.sequences), sorted(os.listdir(tmp_dir.name))
+        (['a'], ['a.000000.bmp', 'manifest.json'])
+        >>> tmp_dir.cleanup()
+        """
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding='utf-8') as file:
+                self.sequences = json.load(file)
+        else:
+            logging.info('RETN NO MANIFEST, SCANNING %s', self.path)
+            self.sequences = scan_sequences(self.path)
+        for name, seq in list(self.sequences.items()):
+            if seq['status'] == STATUS_RUNNING and os.path.exists(
+                    os.path.join(self.path, name + CHECKPOINT_EXT + '.json')):
+                logging.info('RETN KEEP %s (checkpoint)', name)
+            elif seq['status'] != STATUS_DONE:
+                self.delete(name)
+        if not os.path.exists(self.manifest_path):  # also read by the gallery on start
+            self.write_manifest()
+        return self.sequences
+
+    def write_manifest(self):
+        """Write the manifest file."""
+        write_atomic(json.dumps(self.sequences, indent=1), self.manifest_path)
+        self.manifest_changed = False
+
+    def stop(self):
+        """Stop the thread."""
+        super().stop()
+        self.queue_in.put(None)  # break busy waiting
+
+
+def scan_sequences(path):
+    """Group existing output files in a directory into sequences.
+
+    Args:
+        path (str): directory with output files (``<name>.<step>.<fmt>`` or ``<name>.frames``)
+
+    Returns:
+        dict of sequence information by name
+
+    >>> import tempfile
+    >>> tmp_dir = tempfile.TemporaryDirectory()
+    >>> for filename in ('a.000000.bmp', 'a.000001.bmp', 'b.frames', 'c.txt'):
+    ...     open(os.path.join(tmp_dir.name, filename), 'wb').close()
+    >>> sorted((name, seq['status'], seq['files'])
+    ...        for name, seq in scan_sequences(tmp_dir.name).items())
+    [('a', 'done', ['a.000000.bmp', 'a.000001.bmp']), ('b', 'done', ['b.frames'])]
+    >>> tmp_dir.cleanup()
+    """
+    pattern = re.compile(r'^(.+)\.(\d{6}\.[^.]+|frames)$')
+    sequences = dict()
+    for filename in sorted(os.listdir(path)):
+        match = pattern.match(filename)
+        if not match:
+            continue
+        filepath = os.path.join(path, filename)
+        seq = sequences.setdefault(match.group(1), {'status': STATUS_DONE, 'time': 0,
+                                                    'bytes': 0, 'files': []})
+        seq['files'].append(filename)
+        seq['bytes'] += get_size(filepath)
+        seq['time'] = max(seq['time'], os.path.getmtime(filepath))
+    return sequences
+
+
+def get_size(filepath):
+    """Get disk space used by a file in bytes, 0 if file does not exist.
+
+    Frame stores are preallocated sparse files, so the allocated blocks are counted,
+    not the apparent size (where the platform reports them).
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return 0
+    if hasattr(stat, 'st_blocks'):
+        return stat.st_blocks * 512
+    return stat.st_size
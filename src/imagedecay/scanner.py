@@ -8,10 +8,14 @@ import time
 from imagedecay.thread import MyThread
 
 class Scanner(MyThread):
-    """Scan a directory periodically for new files matching a pattern and call a given function."""
-    def __init__(self, queue, path, interval_s, file_pattern=r'.*\.py'):
+    """Scan a directory periodically for new files matching a pattern and call a given function.
+
+    Skipped files are also put on the optional probe queue as ``(time, 'skip', filepath)``.
+    """
+    def __init__(self, queue, path, interval_s, file_pattern=r'.*\.py', queue_probe=None):
         super().__init__()
         self.queue = queue
+        self.queue_probe = queue_probe
         self.path = path
         self.interval_s = float(interval_s)
         self.file_pattern = re.compile(file_pattern, re.IGNORECASE)
@@ -33,6 +37,8 @@ class Scanner(MyThread):
                 latest = new_files_by_mtime[0][1]
                 for dummy_ctime, filename in new_files_by_mtime[1:]:
                     logging.info('SCAN SKIP %s', filename)
+                    if self.queue_probe:
+                        self.queue_probe.put((time.time(), 'skip', filename))
                 logging.info('SCAN ADD %s', latest)
                 self.queue.put(latest)  # put in path
                 self.files = self.files | new_files
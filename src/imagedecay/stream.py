@@ -0,0 +1,137 @@
+# coding=utf-8
+"""Stream the displayed images as MJPEG over http."""
+
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from imagedecay.readwrite import read, encode, get_format, parse_frame_ref, read_frame
+from imagedecay.readwrite import RAW_FORMATS
+from imagedecay.thread import MyThread
+
+BOUNDARY = b'imagedecayframe'
+PAGE = (b'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>imagedecay</title>\n'
+        b'</head>\n<body style="margin:0;background:#000">\n'
+        b'<img src="stream.mjpg" style="width:100%;height:100vh;object-fit:contain">\n'
+        b'</body>\n</html>\n')
+
+
+class Stream(MyThread):
+    """Encode each image from the input queue once and send it to all connected browsers.
+
+    The latest encoded frame is kept in a single shared buffer. Every client is
+    served by its own thread and always gets the newest frame when it is ready
+    for the next one, so slow clients skip frames instead of holding up the others.
+    ``/`` is a page showing the stream, ``/stream.mjpg`` the stream itself.
+    """
+    def __init__(self, queue_in, port, host='', quality=80, client_timeout_s=10.0):
+        super().__init__()
+        self.queue_in = queue_in
+        self.quality = quality
+        self.frame = None  # encoded jpg (bytes)
+        self.frame_index = 0
+        self.condition = threading.Condition()
+        handler = type('StreamHandler', (StreamHandler,), {'stream': self,
+                                                           'timeout': client_timeout_s})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    def run(self):
+        """Main thread."""
+        logging.info("STRM START %s:%d", *self.server.server_address[:2])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        while self.running:
+            imgpath = self.queue_in.get_last_wait()  # skip images that could not be sent
+            if not imgpath:
+                continue
+            try:
+                self.publish(self.load_encoded(imgpath))
+            except Exception as err:
+                logging.warning('STRM ENCODE FAILED %s: %s', imgpath, err)
+        self.server.shutdown()
+        self.server.server_close()
+        logging.info("STRM STOP")
+
+    def load_encoded(self, imgpath):
+        """Get image as jpg (jpg files are not encoded again)."""
+        if parse_frame_ref(imgpath):
+            return encode(read_frame(imgpath), 'jpg', quality=self.quality)
+        fmt = get_format(imgpath)
+        if fmt in ('jpg', 'jpeg'):
+            with open(imgpath, 'rb') as file:
+                return file.read()
+        if fmt in RAW_FORMATS:
+            return encode(np.load(imgpath), 'jpg', quality=self.quality)
+        im_array, dummy_meta = read(imgpath)
+        return encode(im_array, 'jpg', quality=self.quality)
+
+    def publish(self, frame):
+        """Replace the shared frame and wake up all clients."""
+        with self.condition:
+            self.frame = frame
+            self.frame_index += 1
+            self.condition.notify_all()
+
+    def wait_frame(self, last_index, timeout_s=1.0):
+        """Wait for a frame newer than ``last_index``.
+
+        Returns:
+            pair of (frame index, frame), frame is None on timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame_index != last_index or not self.running,
+                                    timeout_s)
+            if self.frame_index == last_index:
+                return last_index, None
+            return self.frame_index, self.frame
+
+    def stop(self):
+        """Stop the thread."""
+        super().stop()
+        self.queue_in.put(None)  # break busy waiting
+        with self.condition:
+            self.condition.notify_all()
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """Handle one http client."""
+    stream = None  # set in subclass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Handle GET request."""
+        if self.path in ('/', '/index.html'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+        elif self.path == '/stream.mjpg':
+            self.send_stream()
+        else:
+            self.send_error(404)
+
+    def send_stream(self):
+        """Send frames until the client disconnects or the stream stops."""
+        logging.info('STRM CLIENT %s', self.client_address[0])
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=%s'
+                         % BOUNDARY.decode())
+        self.end_headers()
+        frame_index = 0
+        try:
+            while self.stream.running:
+                frame_index, frame = self.stream.wait_frame(frame_index)
+                if frame is None:
+                    continue
+                self.wfile.write(b'--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n'
+                                 % (BOUNDARY, len(frame)))
+                self.wfile.write(frame)
+                self.wfile.write(b'\r\n')
+        except OSError as err:  # disconnected or timed out
+            logging.info('STRM CLIENT %s GONE (%s)', self.client_address[0], err)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log requests with logging instead of stderr."""
+        logging.debug('STRM %s ' + format, self.client_address[0], *args)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Apply many variants of a filter configuration to one image and create a contact sheet.
+
+All variants are sequences of filter applications (the configuration, repeated for every
+iteration). They are arranged in a tree, so leading steps that are identical in several
+variants are computed only once.
+"""
+
+import copy
+import itertools
+import json
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from skimage.transform import rescale
+from imagedecay.filter import apply_filterconf, get_conf
+from imagedecay.readwrite import read, write
+from imagedecay.thread import main_setup
+
+CMD_ARGS = [  # list of pairs of (args_tuple, kwargs_dict)
+    (['source_image'], {
+        'help': 'path source image',
+        'type': str
+    }),
+    (['temp_image_dir'], {
+        'help': 'path for results and contact sheet',
+        'type': str
+    }),
+    (['--filterconf', '-f'], {
+        'help': 'path to base filter configuration file',
+        'required': True
+    }),
+    (['--grid', '-g'], {
+        'help': 'parameter grid as json (or path to json file), e.g. '
+                '\'{"noise.cmax": [0.2, 0.5], "3.power_0": [1.1, 1.3], "iter": [5, 10]}\'',
+        'required': True
+    }),
+    (['--iter', '-n'], {
+        'help': 'number of iterations (if not in grid)',
+        'default': 5,
+        'type': int
+    }),
+    (['--max_size'], {
+        'help': 'resize source image to fit in this size (pixels)',
+        'type': int
+    }),
+    (['--jobs', '-j'], {
+        'help': 'number of variants computed in parallel',
+        'default': 1,
+        'type': int
+    }),
+    (['--thumb_size'], {
+        'help': 'size of contact sheet tiles (pixels)',
+        'default': 256,
+        'type': int
+    }),
+    (['--output_fmt'], {
+        'help': 'output file format',
+        'default': 'png'
+    })
+]
+
+
+def get_variants(conf, grid, n_iter):
+    """Create filter configurations for all combinations of grid values.
+
+    Args:
+        conf (list): base filter configuration
+        grid (dict): lists of values by parameter. Parameters are ``iter`` or
+            ``<filter>.<kwarg>``, with filter as index or name (first filter with that name).
+        n_iter (int): number of iterations, if not in grid
+
+    Returns:
+        list of tuples (params, conf, n_iter)
+
+    >>> v = get_variants([{'name': 'noise', 'kwargs': {'cmax': 1}}], {'noise.cmax': [1, 2]}, 3)
+    >>> [(p, c[0]['kwargs']['cmax'], n) for p, c, n in v]
+    [({'noise.cmax': 1}, 1, 3), ({'noise.cmax': 2}, 2, 3)]
+    """
+    keys = sorted(grid)
+    variants = list()
+    for values in itertools.product(*[grid[k] for k in keys]):
+        params = dict(zip(keys, values))
+        conf_variant = copy.deepcopy(conf)
+        n_iter_variant = n_iter
+        for key, value in params.items():
+            if key == 'iter':
+                n_iter_variant = int(value)
+                continue
+            flt, kwarg = key.split('.', 1)
+            if flt.isdigit():
+                flt_conf = conf_variant[int(flt)]
+            else:
+                flt_conf = [c for c in conf_variant if c['name'] == flt][0]
+            flt_conf['kwargs'][kwarg] = value
+        variants.append((params, conf_variant, n_iter_variant))
+    return variants
+
+
+class SweepNode():
+    """Node in the tree of filter steps: all variants sharing the steps up to here."""
+    def __init__(self, step=None):
+        self.step = step  # filter configuration
+        self.children = dict()  # by serialized step
+        self.variants = list()  # indices of variants that end here
+
+    def add(self, steps, variant):
+        """Add the remaining steps of a variant below this node."""
+        node = self
+        for step in steps:
+            key = json.dumps(step, sort_keys=True)
+            node = node.children.setdefault(key, SweepNode(step))
+        node.variants.append(variant)
+
+    def count(self):
+        """Count steps in this subtree (iterative, chains can be very long).
+
+        >>> conf = [{'name': 'noise', 'kwargs': {}}]
+        >>> build_tree(get_variants(conf, {'iter': [2000, 3000]}, 1)).count()
+        3000
+        """
+        n_steps = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            n_steps += len(node.children)
+            stack.extend(node.children.values())
+        return n_steps
+
+
+def build_tree(variants):
+    """Create tree of filter steps from variants (see ``get_variants``)."""
+    root = SweepNode()
+    for index, (dummy_params, conf, n_iter) in enumerate(variants):
+        root.add(conf * n_iter, index)
+    return root
+
+
+def follow(node, im_array, results):
+    """Apply filter steps from node down to the next branch (or the end).
+
+    Args:
+        node (SweepNode): start node
+        im_array (array): image data before the step of the node
+        results (dict): results by variant index (output)
+
+    Returns:
+        pair of (last node, image data after its step)
+    """
+    while True:
+        if node.step is not None:
+            im_array = apply_filterconf(im_array, [node.step])
+        for variant in node.variants:
+            results[variant] = im_array
+        if len(node.children) != 1:
+            return node, im_array
+        node = next(iter(node.children.values()))
+
+
+def evaluate(node, im_array, results):
+    """Apply filter steps of subtree, depth first.
+
+    Intermediate arrays are only kept at branches until all children are done.
+    """
+    node, im_array = follow(node, im_array, results)
+    for child in node.children.values():
+        evaluate(child, im_array, results)
+
+
+def run_sweep(im_array, variants, n_jobs=1):
+    """Compute all variants.
+
+    The shared steps are computed once, the branches of the first split
+    in parallel.
+
+    Returns:
+        list of image arrays by variant
+    """
+    root = build_tree(variants)
+    n_steps = sum(len(conf) * n_iter for dummy_params, conf, n_iter in variants)
+    logging.info('SWEEP %d variants, %d filter steps (%d without shared steps)',
+                 len(variants), root.count(), n_steps)
+    results = dict()
+    node, im_array = follow(root, im_array, results)
+    with ThreadPoolExecutor(max(1, n_jobs)) as executor:
+        futures = [executor.submit(evaluate, child, im_array, results)
+                   for child in node.children.values()]
+        for future in futures:
+            future.result()
+    return [results[i] for i in range(len(variants))]
+
+
+def contact_sheet(im_arrays, thumb_size, padding=4):
+    """Arrange images as tiles of a grid.
+
+    Args:
+        im_arrays (list): image arrays
+        thumb_size (int): maximum width and height of tiles
+
+    Returns:
+        image array
+    """
+    n_cols = int(math.ceil(math.sqrt(len(im_arrays))))
+    n_rows = int(math.ceil(len(im_arrays) / n_cols))
+    tile = thumb_size + padding
+    sheet = np.ones((n_rows * tile + padding, n_cols * tile + padding, 3))
+    for i, im_array in enumerate(im_arrays):
+        scale = min(thumb_size / im_array.shape[0], thumb_size / im_array.shape[1], 1.0)
+        if scale < 1.0:
+            im_array = rescale(im_array, scale, mode='constant', channel_axis=2)
+        top = (i // n_cols) * tile + padding
+        left = (i % n_cols) * tile + padding
+        sheet[top:top + im_array.shape[0], left:left + im_array.shape[1]] = im_array
+    return sheet
+
+
+def main(source_image, temp_image_dir, **kwargs):
+    """Entry point for main script."""
+    conf = get_conf(kwargs['filterconf'])
+    grid = kwargs['grid']
+    if os.path.exists(grid):
+        with open(grid, encoding='utf-8') as file:
+            grid = json.load(file)
+    else:
+        grid = json.loads(grid)
+    variants = get_variants(conf, grid, kwargs['iter'])
+    im_array, dummy_meta = read(source_image)
+    max_size = kwargs.get('max_size')
+    if max_size:
+        scale = min(max_size / im_array.shape[0], max_size / im_array.shape[1], 1.0)
+        im_array = rescale(im_array, scale, mode='constant', channel_axis=2)
+    results = run_sweep(im_array, variants, kwargs['jobs'])
+    basename = os.path.basename(source_image)
+    index = list()
+    for i, ((params, dummy_conf, dummy_n_iter), result) in enumerate(zip(variants, results)):
+        filepath = os.path.join(temp_image_dir, '%s.sweep.%04d.%s' % (basename, i,
+                                                                    kwargs['output_fmt']))
+        write(result, filepath)
+        index.append({'file': os.path.basename(filepath), 'params': params})
+    sheet_path = os.path.join(temp_image_dir, '%s.sweep.%s' % (basename, kwargs['output_fmt']))
+    write(contact_sheet(results, kwargs['thumb_size']), sheet_path)
+    with open(os.path.join(temp_image_dir, '%s.sweep.json' % basename), 'w',
+              encoding='utf-8') as file:
+        json.dump(index, file, indent=1)
+    logging.info('SWEEP CONTACT SHEET %s', sheet_path)
+
+
+if __name__ == '__main__':
+    main_setup(main, cmd_args=CMD_ARGS, default_loglevel='WARNING')
@@ -3,12 +3,16 @@
 
 from threading import Thread
 import logging
+import multiprocessing
 import sys
 from queue import Queue, Empty
 
 import configargparse
 Thread()
 
+LOG_FORMAT = '[%(asctime)s %(funcName)s %(levelname)s] %(message)s'
+MP_CONTEXT = multiprocessing.get_context('spawn')  # child processes do not inherit pygame/SDL
+
 class MyThread(Thread):
     """Simple stoppable thread."""
     def __init__(self, daemon=True):
@@ -76,6 +80,53 @@ class MyQueue():
         return item
 
 
+class MyProcessQueue(MyQueue):
+    """Synchronized queue that can be shared with child processes"""
+    def __init__(self):
+        super().__init__()
+        self._queue = MP_CONTEXT.Queue()
+
+
+class ThreadProcess(MP_CONTEXT.Process):
+    """Run threads in a separate process.
+
+    The threads are created in the child process from pairs of (MyThread subclass, kwargs),
+    so all arguments must be picklable (use MyProcessQueue for queues).
+    """
+    def __init__(self, thread_specs, join_timeout_s=5.0):
+        super().__init__(daemon=True)
+        self.thread_specs = thread_specs
+        self.join_timeout_s = join_timeout_s
+        root = logging.getLogger()  # log in the child what is shown here
+        self.loglevel = max([root.getEffectiveLevel()] + [h.level for h in root.handlers])
+        self.stop_event = MP_CONTEXT.Event()
+
+    def run(self):
+        """Main function of the child process."""
+        logging.basicConfig(format=LOG_FORMAT, level=self.loglevel)
+        threads = [thread_class(**kwargs) for thread_class, kwargs in self.thread_specs]
+        logging.info('PROC START %s', ', '.join(type(t).__name__ for t in threads))
+        for thread in threads:
+            thread.start()
+        try:
+            self.stop_event.wait()
+        except KeyboardInterrupt:
+            pass
+        for thread in threads:
+            thread.stop()
+        for thread in threads:
+            thread.join(timeout=self.join_timeout_s)
+        logging.info('PROC STOP')
+
+    def stop(self):
+        """Stop the threads and wait for the process to end (kill it after a timeout)."""
+        self.stop_event.set()
+        self.join(timeout=self.join_timeout_s * 2)
+        if self.is_alive():
+            logging.warning('PROC TERMINATE')
+            self.terminate()
+
+
 def main_setup(main_fun, cmd_args, default_loglevel):
     """Prepare arguments and environment for main."""
     # command line > environment variables > config file values > defaults
@@ -102,7 +153,7 @@ def main_setup(main_fun, cmd_args, default_loglevel):
     # reset basic config, set loglevel
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
-    logging.basicConfig(format='[%(asctime)s %(funcName)s %(levelname)s] %(message)s',
+    logging.basicConfig(format=LOG_FORMAT,
                         level=getattr(logging, kwargs.get('loglevel').upper()))
     logging.debug('ARGUMENTS:\n' + argp.format_values())
     # main wrapper
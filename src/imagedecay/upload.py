@@ -0,0 +1,234 @@
+# coding=utf-8
+"""Receive images over http and send them to the converter."""
+
+import email.parser
+import email.policy
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from imagedecay.readwrite import decode, ImageTooLargeError
+from imagedecay.thread import MyThread, MyQueue
+
+PAGE = (b'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+        b'<meta name="viewport" content="width=device-width">\n<title>imagedecay</title>\n'
+        b'</head>\n<body>\n<form method="post" action="upload" enctype="multipart/form-data">\n'
+        b'<input type="file" name="image" accept="image/*">\n<input type="submit">\n'
+        b'</form>\n</body>\n</html>\n')
+
+
+class Upload(MyThread):
+    """Accept images by http POST and put them into the converter queue as ``(filepath, im_array)``.
+
+    Images are decoded in memory by the request threads. At most ``max_uploads``
+    requests are handled at the same time (others get 503), larger bodies than
+    ``max_bytes`` and images with more than ``max_pixels`` are refused (413).
+    Every accepted image cancels the running sequence, so after an accepted upload,
+    others are refused for ``min_interval_s`` (429), to let the sequence get going.
+    If ``path`` is set, the original files are written there in this thread. The path
+    should not be scanned by the scanner, or the image would be converted twice.
+    ``/`` is a page with an upload form, ``/upload`` takes the image as request body
+    or as (first) file of a form.
+    """
+    def __init__(self, queue_out, port, path=None, host='', max_bytes=20e6, max_pixels=50e6,
+                 max_uploads=2, min_interval_s=10.0, client_timeout_s=30.0):
+        super().__init__()
+        self.queue_out = queue_out
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.max_pixels = int(max_pixels)
+        self.slots = threading.BoundedSemaphore(max_uploads)
+        self.min_interval_s = float(min_interval_s)
+        self.last_accepted = None  # time.monotonic() of the last accepted upload
+        self.lock = threading.Lock()
+        self.queue_save = MyQueue()
+        self.wait_interval_s = 0.1
+        if path:
+            os.makedirs(path, exist_ok=True)
+        handler = type('UploadHandler', (UploadHandler,), {'upload': self,
+                                                           'timeout': client_timeout_s})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    def run(self):
+        """Main thread."""
+        logging.info("UPLD START %s:%d", *self.server.server_address[:2])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        while self.running:
+            item = self.queue_save.get_first_nowait()
+            if item:
+                self.save(*item)
+            else:
+                time.sleep(self.wait_interval_s)
+        self.server.shutdown()
+        self.server.server_close()
+        item = self.queue_save.get_first_nowait()
+        while item:
+            self.save(*item)
+            item = self.queue_save.get_first_nowait()
+        logging.info("UPLD STOP")
+
+    def get_wait_s(self):
+        """Get time until the next upload is accepted in s (0 if now)."""
+        if self.last_accepted is None:
+            return 0.0
+        return max(0.0, self.last_accepted + self.min_interval_s - time.monotonic())
+
+    def ingest(self, data):
+        """Decode image and send it to the converter.
+
+        Args:
+            data (bytes): encoded image
+
+        Returns:
+            file path (used as name of the sequence), or None if another upload
+            was accepted less than ``min_interval_s`` ago
+
+        Raises:
+            ImageTooLargeError: image has too many pixels
+        """
+        fmt = get_image_format(data)
+        im_array = decode(data, max_pixels=self.max_pixels)
+        with self.lock:  # check again, other uploads may have finished meanwhile
+            if self.get_wait_s() > 0:
+                return None
+            self.last_accepted = time.monotonic()
+        filename = '_upload.%d.%s' % (int(time.time() * 1000), fmt)
+        filepath = os.path.join(self.path, filename) if self.path else filename
+        logging.info('UPLD IMAGE %s (%d x %d)', filepath, im_array.shape[1], im_array.shape[0])
+        self.queue_out.put((filepath, im_array))
+        if self.path:
+            self.queue_save.put((filepath, data))
+        return filepath
+
+    @staticmethod
+    def save(filepath, data):
+        """Write original file."""
+        with open(filepath + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(filepath + '.tmp', filepath)
+
+    def stop(self):
+        """Stop the thread."""
+        super().stop()
+        self.queue_save.put(None)  # break busy waiting
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    """Handle one http request."""
+    upload = None  # set in subclass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Handle GET request."""
+        if self.path in ('/', '/index.html'):
+            self.send_content(200, PAGE, 'text/html')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Handle POST request."""
+        if self.path != '/upload':
+            self.send_error(404)
+            return
+        if self.upload.get_wait_s() > 0:
+            self.send_too_early()
+            return
+        if not self.upload.slots.acquire(blocking=False):
+            self.send_error(503, 'Too many uploads')
+            return
+        try:
+            self.receive()
+        except OSError as err:  # disconnected or timed out
+            logging.info('UPLD CLIENT %s GONE (%s)', self.client_address[0], err)
+        finally:
+            self.upload.slots.release()
+
+    def receive(self):
+        """Read, check and ingest the uploaded image."""
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+        if length > self.upload.max_bytes:
+            self.send_error(413, 'Upload too large')
+            self.close_connection = True
+            return
+        data = self.rfile.read(length)
+        if len(data) < length:
+            raise ConnectionAbortedError('incomplete upload')
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            data = get_form_file(data, content_type)
+        if not get_image_format(data or b''):
+            self.send_error(415, 'Unknown image format')
+            return
+        try:
+            filepath = self.upload.ingest(data)
+        except ImageTooLargeError as err:
+            self.send_error(413, str(err))
+            return
+        except Exception as err:  # decoder errors
+            logging.warning('UPLD DECODE FAILED: %s', err)
+            self.send_error(400, 'Cannot decode image')
+            return
+        if not filepath:
+            self.send_too_early()
+            return
+        body = json.dumps({'file': os.path.basename(filepath)}).encode()
+        self.send_content(202, body, 'application/json')
+
+    def send_too_early(self):
+        """Refuse upload because the last one was accepted too recently."""
+        wait_s = int(self.upload.get_wait_s()) + 1
+        body = json.dumps({'retry_after_s': wait_s}).encode()
+        self.send_content(429, body, 'application/json', {'Retry-After': str(wait_s)})
+
+    def send_content(self, code, body, content_type, headers=None):
+        """Send complete response."""
+        self.send_response(code)
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log requests with logging instead of stderr."""
+        logging.debug('UPLD %s ' + format, self.client_address[0], *args)
+
+
+def get_form_file(data, content_type):
+    """Get content of the first file in a multipart/form-data body (None if there is none).
+
+    >>> get_form_file(b'--x\\r\\nContent-Disposition: form-data; name="a"; filename="a.png"\\r\\n'
+    ...               b'\\r\\nabc\\r\\n--x--\\r\\n', 'multipart/form-data; boundary=x')
+    b'abc'
+    """
+    header = ('Content-Type: %s\r\nMIME-Version: 1.0\r\n\r\n' % content_type).encode()
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + data)
+    for part in message.iter_parts():
+        if part.get_filename() is not None:
+            return part.get_payload(decode=True)
+    return None
+
+
+def get_image_format(data):
+    """Get image format from the first bytes of an encoded image (None if unknown).
+
+    >>> get_image_format(b'\\x89PNG\\r\\n\\x1a\\n...')
+    'png'
+    """
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data.startswith(b'BM'):
+        return 'bmp'
+    if data.startswith(b'RIFF') and data[8:12] == b'WEBP':
+        return 'webp'
+    return None